@@ -1,9 +1,12 @@
-from flask import Blueprint, request, session, redirect, render_template
+from flask import Blueprint, request, session, redirect, render_template, Response, stream_with_context
 import core
+import core.auth as auth
+import core.rate_limit as rate_limit
+import core.repository as repository
 import tools
 import logging
-import bcrypt
 import json
+import math
 import traceback
 import sys
 from whenareyou import whenareyou
@@ -19,6 +22,59 @@ log = logging.getLogger()
 
 api = Blueprint('api', __name__, template_folder='templates')
 
+@api.before_request
+def limit_requests():
+    '''
+    Admission control for the API. Checks the request against the session, user, client ip, and global token
+    buckets, and rejects it before any parsing or plugin work if one of them is empty
+
+    :return an error response if the request was rejected, None otherwise:
+    '''
+    if request.is_json:
+        request_data = request.get_json(silent=True)
+        #The body can be any json value, but only an object carries session ids or tokens
+        if not isinstance(request_data, dict):
+            request_data = {}
+    else:
+        request_data = request.form
+    session_id = request_data.get("session_id", request.args.get("session_id"))
+    client_ip = None
+    if session_id in core.sessions.keys():
+        username = core.sessions[session_id]["username"]
+    else:
+        #Only buckets for real sessions are kept, and only verified tokens are charged to a user. Anything else
+        #is limited by its address, so a request naming a user can't drain that user's bucket
+        session_id = None
+        token = request_data.get("token", request.args.get("token"))
+        username = auth.verify_token(token) if token else None
+        if username is None:
+            client_ip = request.remote_addr
+    rejected_scope = rate_limit.allow(username, session_id, client_ip)
+    if rejected_scope:
+        log.info(":API:Rejected request to {0}, {1} rate limit exceeded".format(request.path, rejected_scope))
+        return tools.return_json({
+            "type": "error",
+            "text": "Rate limit exceeded, please slow down",
+            "data": {"scope": rejected_scope}
+        })
+
+def authenticate(request_data):
+    '''
+    Authenticate request data with either a token from /api/get_token or a username and password.
+    Token checks are served from the in memory token cache, so only the password path runs bcrypt
+
+    :param request_data:
+    :return the authenticated username, or None:
+    '''
+    if "token" in request_data.keys():
+        return auth.verify_token(request_data["token"])
+    username = request_data["username"]
+    password = request_data["password"]
+    user_table = repository.user_by_username(db, username)
+    if user_table and auth.check_password(password, user_table["password"]):
+        return username
+    return None
+
 @api.route('/new_user', methods=["GET","POST"])
 def new_user():
     '''
@@ -53,8 +109,7 @@ def new_user():
         if passed:
             log.debug("Attempting to create new user with username {0} and email {1}".format(username, email))
             # Check to see if the username exists
-            users = db["users"]
-            if users.find_one(username=username):
+            if repository.user_by_username(db, username):
                 # If that username is already taken
                 taken_message = "Username {0} is already taken".format(username)
                 log.debug(taken_message)
@@ -63,11 +118,11 @@ def new_user():
             else:
                 # Add the new user to the database
                 log.info(":{0}:Adding a new user to the database".format(username))
-                db.begin()
-                # Hash the password
+                # Hash the password on the hashing pool before opening the transaction
                 log.debug("Hashing password")
-                hashed = bcrypt.hashpw(password.encode('utf8'), bcrypt.gensalt())
+                hashed = auth.hash_password(password)
                 log.debug("Hashed password is {0}".format(hashed))
+                db.begin()
                 is_admin = username in configuration_data["admins"]
                 try:
                     db['users'].insert({
@@ -99,6 +154,9 @@ def new_user():
             response["type"] = "error"
             response["text"] = "Invalid input, valid chars are {0}".format(tools.valid_chars)
 
+    except auth.AuthBusy:
+        response["type"] = "error"
+        response["text"] = "The server is busy, please try again in a moment"
     except KeyError:
         log.error("Needed data not found in new user request")
         response["type"] = "error"
@@ -113,6 +171,7 @@ def settings():
     """
     :param username:
     :param password:
+    :param token: Optional - can be submitted instead of a password
     :param Optional - setting to be changed:
     Change the users settings
 
@@ -124,22 +183,19 @@ def settings():
         request_data = request.get_json()
     else:
         request_data = request.form
-    if "username" in request_data.keys() and "password" in request_data.keys():
-        username = request_data["username"]
-        password = request_data["password"]
-        if tools.check_string(request_data.values()):
-            user_table = db["users"].find_one(username=username)
-            if user_table:
-                db_hash = user_table["password"]
-                if bcrypt.checkpw(password.encode('utf8'), db_hash.encode('utf8')):
+    if "token" in request_data.keys() or ("username" in request_data.keys() and "password" in request_data.keys()):
+        if tools.check_string(list(request_data.values())):
+            try:
+                username = authenticate(request_data)
+                if username:
                     #TODO: write a framework that allows changing of notifications
-                    immutable_settings = ["username", "admin", "id", "user_token", "notifications", "password"]
+                    immutable_settings = ["username", "admin", "id", "user_token", "notifications", "password", "token"]
                     db.begin()
                     log.info(":{0}:Changing settings for user".format(username))
                     try:
                         for setting in request_data.keys():
                             if setting not in immutable_settings:
-                                db["users"].upsert({"username": username, setting: request.form[setting]}, ['username'])
+                                db["users"].upsert({"username": username, setting: request_data[setting]}, ['username'])
                         db.commit()
                         response["type"] = "success"
                         response["text"] = "Updated settings"
@@ -150,16 +206,19 @@ def settings():
                         response["type"] = "error"
                         response["text"] = "Error encountered while trying to update db, changes not committed"
                         db.rollback()
-            else:
+                else:
+                    response["type"] = "error"
+                    response["text"] = "Invalid username/password combination or token"
+            except auth.AuthBusy:
                 response["type"] = "error"
-                response["text"] = "User {0} doesn't exist".format(username)
+                response["text"] = "The server is busy, please try again in a moment"
         else:
             response["type"] = "error"
             response["text"] = "Invalid input"
 
     else:
         response["type"] = "error"
-        response["text"] = "Couldn't find username or password in request data"
+        response["text"] = "Couldn't find username and password or token in request data"
     return tools.return_json(response)
 
 @api.route('/get_sessions', methods=["GET", "POST"])
@@ -168,6 +227,7 @@ def get_sessions():
     Return list of active sessions for user
     :param: username
     :param: password
+    :param: token: Optional - can be submitted instead of a username and password
     :return: list of sessions
     """
     log.info(":API:/api/get_sessions")
@@ -178,28 +238,92 @@ def get_sessions():
     else:
         request_data = request.form
     try:
-        username = request_data["username"]
-        password = request_data["password"]
-        if tools.check_string(request_data.values()):
-            db_hash = db['users'].find_one(username=username)["password"]
-            user_auth = bcrypt.checkpw(password.encode('utf8'), db_hash.encode('utf8'))
-            if user_auth:
+        if tools.check_string(list(request_data.values())):
+            username = authenticate(request_data)
+            if username:
                 response["data"].update({"sessions":[]})
                 for user_session in sessions:
                     if sessions[user_session]["username"] == username:
-                        response["data"]["sessions"].append(session)
+                        response["data"]["sessions"].append(user_session)
                 response["type"] = "success"
                 response["text"] = "Fetched active sessions"
             else:
                 response["type"] = "error"
-                response["text"] = "Invalid username/password combination"
+                response["text"] = "Invalid username/password combination or token"
         else:
             response["type"] = "error"
             response["text"] = "One of the submitted parameters contained an invalid character. " \
                                "Valid characters are {0}".format(tools.valid_chars)
+    except auth.AuthBusy:
+        response["type"] = "error"
+        response["text"] = "The server is busy, please try again in a moment"
+    except KeyError:
+        response["type"] = "error"
+        response["text"] = "Couldn't find username and password or token in request"
+    return tools.return_json(response)
+
+@api.route('/get_token', methods=["POST"])
+def get_token():
+    """
+    Check a username and password once and return a short lived token that can be used in place of them
+    :param: username
+    :param: password
+    :return: token
+    """
+    log.info(":API:/api/get_token")
+    response = {"type": None, "data": {}, "text": None}
+    if request.is_json:
+        request_data = request.get_json()
+    else:
+        request_data = request.form
+    try:
+        username = request_data["username"]
+        password = request_data["password"]
+        if tools.check_string([username, password]):
+            if authenticate({"username": username, "password": password}):
+                token = auth.issue_token(username)
+                response["type"] = "success"
+                response["text"] = "Authentication successful"
+                response["data"].update({"token": token, "expires_in": auth.token_ttl})
+            else:
+                response["type"] = "error"
+                response["text"] = "Invalid username/password combination"
+        else:
+            response["type"] = "error"
+            response["text"] = "Invalid input"
+    except auth.AuthBusy:
+        response["type"] = "error"
+        response["text"] = "The server is busy, please try again in a moment"
+    except KeyError:
+        response["type"] = "error"
+        response["text"] = "Couldn't find username and password in request data"
+    return tools.return_json(response)
+
+@api.route('/revoke_token', methods=["POST"])
+def revoke_token():
+    """
+    Revoke a token from /api/get_token before it expires
+    :param: token
+    :return:
+    """
+    log.info(":API:/api/revoke_token")
+    response = {"type": None, "data": {}, "text": None}
+    if request.is_json:
+        request_data = request.get_json()
+    else:
+        request_data = request.form
+    try:
+        token = request_data["token"]
+        if auth.verify_token(token):
+            auth.revoke_token(token)
+            response["type"] = "success"
+            response["text"] = "Revoked token"
+        else:
+            response["type"] = "error"
+            response["text"] = "Invalid token"
     except KeyError:
         response["type"] = "error"
-        response["text"] = "Couldn't find username and password in request"
+        response["text"] = "Couldn't find token in request data"
     return tools.return_json(response)
 
 
@@ -232,13 +356,11 @@ def start_session():
                 raise KeyError()
         if tools.check_string([username, password]):
             log.info(":{0}:Checking password".format(username))
-            users = db["users"]
-            user_data = users.find_one(username=username)
+            user_data = repository.user_by_username(db, username)
             if user_data:
-                user_data = db["users"].find_one(username=username)
                 # Check the password
                 db_hash = user_data["password"]
-                user_auth = bcrypt.checkpw(password.encode('utf8'), db_hash.encode('utf8'))
+                user_auth = auth.check_password(password, db_hash)
                 if user_auth:
                     log.info(":{0}:Authentication successful".format(username))
                     # Return the session id to the user
@@ -256,6 +378,9 @@ def start_session():
         else:
             response["type"] = "error"
             response["text"] = "Invalid input"
+    except auth.AuthBusy:
+        response["type"] = "error"
+        response["text"] = "The server is busy, please try again in a moment"
     except KeyError:
         response["type"] = "error"
         response["text"] = "Couldn't find username and password in request data"
@@ -378,7 +503,7 @@ def command_response():
                                                   exc_traceback))
                                 log.error(error_string)
                                 username = session_data["username"]
-                                user_table = db["users"].find_one(username=username)
+                                user_table = repository.user_by_username(db, username)
                                 if user_table:
                                     response["type"] = "error"
                                     if user_table["admin"]:
@@ -461,4 +586,171 @@ def process_command():
         log.debug("Couldn't find session id and command in request data")
         response["type"] = "error"
         response["text"] = "Couldn't find session id and command in request data"
-    return tools.return_json(response)
\ No newline at end of file
+    return tools.return_json(response)
+
+@api.route('/reminders/bulk', methods=["POST"])
+def bulk_reminders():
+    """
+    Create many reminders at once, stored in one transaction. Admin only
+    :param username:
+    :param password:
+    :param token: Optional - can be submitted instead of a username and password
+    :param reminders: List of reminders, each with a username, a time in epoch seconds, the reminder text,
+    and optionally a recurrence of hourly, daily, or weekly
+    :return: the number of reminders created
+    """
+    log.info(":API:/api/reminders/bulk")
+    response = {"type": None, "text": None, "data": {}}
+    request_data = request.get_json(silent=True)
+    if not isinstance(request_data, dict):
+        request_data = {}
+    max_reminders = configuration_data.get("bulk_reminders_max", 10000)
+    try:
+        credentials = dict((k, v) for k, v in request_data.items() if k != "reminders")
+        if not tools.check_string(list(credentials.values())):
+            response["type"] = "error"
+            response["text"] = "Invalid input"
+            return tools.return_json(response)
+        username = authenticate(credentials)
+        user_table = repository.user_by_username(db, username) if username else None
+        if not (user_table and user_table["admin"]):
+            response["type"] = "error"
+            response["text"] = "Invalid admin username/password combination or token"
+            return tools.return_json(response)
+        reminders = request_data["reminders"]
+        if not isinstance(reminders, list) or len(reminders) > max_reminders:
+            response["type"] = "error"
+            response["text"] = "reminders must be a list of at most {0} reminders".format(max_reminders)
+            return tools.return_json(response)
+        new_events = []
+        for reminder_num, reminder in enumerate(reminders):
+            if not isinstance(reminder, dict):
+                reminder = {}
+            recurrence = reminder.get("recurrence")
+            if not (isinstance(reminder.get("username"), str) and tools.check_string(reminder["username"])
+                    and isinstance(reminder.get("text"), str) and isinstance(reminder.get("time"), (int, float))
+                    and (recurrence is None or recurrence in core.recurrence_intervals)):
+                response["type"] = "error"
+                response["text"] = "Reminder {0} needs a valid username, text, time, and recurrence".format(
+                    reminder_num)
+                return tools.return_json(response)
+            new_events.append({
+                "username": reminder["username"],
+                "time": float(reminder["time"]),
+                "value": reminder["text"],
+                "type": "notification",
+                "uid": tools.get_event_uid("notification"),
+                "recurrence": recurrence
+            })
+        core.add_events(new_events, db)
+        log.info(":{0}:Created {1} reminders".format(username, len(new_events)))
+        response["type"] = "success"
+        response["text"] = "Created {0} reminders".format(len(new_events))
+        response["data"].update({"created": len(new_events)})
+    except auth.AuthBusy:
+        response["type"] = "error"
+        response["text"] = "The server is busy, please try again in a moment"
+    except KeyError:
+        response["type"] = "error"
+        response["text"] = "Couldn't find credentials and reminders in request data"
+    except Exception as db_error:
+        log.error(":API:Error {0} while creating reminders".format(db_error))
+        response["type"] = "error"
+        response["text"] = "Error encountered while storing the reminders, none were created"
+    return tools.return_json(response)
+
+def parse_timeout(value, max_timeout):
+    '''
+    Parse a client supplied wait time and clamp it to [0, max_timeout]
+
+    :param value:
+    :param max_timeout:
+    :return timeout in seconds. Raises ValueError if it isn't a finite number:
+    '''
+    try:
+        timeout = float(value)
+    except TypeError:
+        raise ValueError("Timeout must be a number")
+    #nan slips through min() and makes a queue wait forever
+    if math.isnan(timeout) or math.isinf(timeout):
+        raise ValueError("Timeout must be a finite number")
+    return min(max(timeout, 0), max_timeout)
+
+@api.route('/updates', methods=["GET", "POST"])
+@api.route('/get_updates', methods=["GET", "POST"])
+def get_updates():
+    """
+    Long poll for updates. Waits until the session has updates or the timeout passes, then returns every pending
+    update, up to the batch size, at once
+    :param session_id:
+    :param timeout: Optional - how many seconds to wait for an update
+    :return response object with a list of updates in data:
+    """
+    log.info(":API:/api/updates")
+    response = {"type": None, "text": None, "data": {}}
+    if request.is_json:
+        request_data = request.get_json()
+    else:
+        request_data = request.values
+    max_timeout = configuration_data.get("updates_max_timeout", 30)
+    batch_size = configuration_data.get("updates_batch_size", 50)
+    try:
+        session_id = request_data["session_id"]
+        timeout = parse_timeout(request_data.get("timeout", max_timeout), max_timeout)
+        if session_id in core.sessions.keys():
+            session_updates = core.sessions[session_id]["updates"]
+            try:
+                #The wait is on the queue's condition, so an idle long poll is just a parked greenlet
+                session_update_list = [session_updates.get(timeout=timeout)]
+                session_update_list.extend(session_updates.drain(batch_size-1))
+            except Queue.Empty:
+                session_update_list = []
+            response["type"] = "success"
+            response["text"] = "Fetched {0} updates".format(len(session_update_list))
+            response["data"].update({"updates": session_update_list})
+        else:
+            response["type"] = "error"
+            response["text"] = "Invalid session id"
+    except ValueError:
+        response["type"] = "error"
+        response["text"] = "Timeout must be a finite number"
+        return tools.return_json(response), 400
+    except KeyError:
+        response["type"] = "error"
+        response["text"] = "Couldn't find session id in request data"
+    return tools.return_json(response)
+
+@api.route('/updates/stream', methods=["GET"])
+def stream_updates():
+    """
+    Stream updates for a session as Server-Sent Events
+    :param session_id:
+    :param timeout: Optional - seconds between keepalives on an idle stream
+    :return text/event-stream response:
+    """
+    log.info(":API:/api/updates/stream")
+    session_id = request.args.get("session_id", "")
+    if session_id not in core.sessions.keys():
+        return tools.return_json({"type": "error", "text": "Invalid session id", "data": {}})
+    session_updates = core.sessions[session_id]["updates"]
+    max_timeout = configuration_data.get("updates_max_timeout", 30)
+    try:
+        #At least a second, so an idle stream doesn't spin sending keepalives
+        heartbeat = max(parse_timeout(request.args.get("timeout", max_timeout), max_timeout), 1)
+    except ValueError:
+        return tools.return_json({"type": "error", "text": "Timeout must be a finite number", "data": {}}), 400
+    batch_size = configuration_data.get("updates_batch_size", 50)
+    def event_stream():
+        log.info(":{0}:Starting update stream".format(session_id))
+        while session_id in core.sessions.keys():
+            try:
+                session_update_list = [session_updates.get(timeout=heartbeat)]
+            except Queue.Empty:
+                #Comment lines keep proxies from closing an idle stream
+                yield ": keepalive\n\n"
+                continue
+            session_update_list.extend(session_updates.drain(batch_size-1))
+            for update in session_update_list:
+                yield "data: {0}\n\n".format(json.dumps(update))
+        log.info(":{0}:Ending update stream for finished session".format(session_id))
+    return Response(stream_with_context(event_stream()), mimetype="text/event-stream")
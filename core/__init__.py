@@ -12,14 +12,38 @@ except ImportError:
     import plugin_handler
     import parser
 import core.notification as notification
+import core.registry as registry
+import core.metrics as metrics
+import core.repository as repository
+import core.write_behind as write_behind
 import tools
 
 log = logging.getLogger()
 
-sessions = {}
+sessions = registry.SessionRegistry()
 
 events = []
 
+configuration_data = {}
+
+db = None
+
+#Only events due within event_horizon seconds are kept in memory. Later ones stay in the events table until the
+#refiller pages them in
+event_horizon = 86400
+
+event_chunk_size = 500
+
+#Events stored in the database are loaded up to this time
+loaded_until = 0
+
+#Held while loading events and while deciding where a new event goes, so an event added during a load can't land
+#in the database behind the load and then be passed over when loaded_until moves
+events_lock = threading.Lock()
+
+#Seconds between occurrences of recurring events, by recurrence rule
+recurrence_intervals = {"hourly": 3600, "daily": 86400, "weekly": 604800}
+
 processed_commands = 0
 
 error_num = 0
@@ -43,26 +67,33 @@ class sessions_monitor():
         global processed_commands
         global error_num
         global success_num
+        global sessions
         processed_commands+=1
+        sessions.record_command()
         # Call the parser
         command_data.update({"db": db})
         parse_data = parser.parse(command_data, session)
         command_id = command_data['id']
         parse_data.update({"command_id": command_data['id']})
         log.info(":{0}:Finished parsing".format(command_id))
+        plugin_start = time.time()
         response = plugin_handler.subscriptions().process_event(parse_data, db)
+        plugin_time = (time.time()-plugin_start)*1000
         log.info("Got response {0} with type {1}".format(response, type(response)))
+        metrics.record("commands")
+        if "plugin" in parse_data.keys():
+            metrics.record("plugin_latency:{0}".format(parse_data["plugin"]), plugin_time, percentiles=True)
         if response["type"] == "success":
             success_num+=1
         else:
             error_num+=1
+            metrics.record("errors")
         log.debug("Got response {0} from plugin handler".format(response))
         log.info("{0}:Setting update for command with response {1}".format(
             command_id, response
         ))
         session_id = session['id']
         #Add the response to the update queue
-        global sessions
         if add_to_updates_queue:
             sessions[session_id]["updates"].put({"command_id": command_id, "response": response})
         if session_id in commands.keys():
@@ -81,8 +112,11 @@ class sessions_monitor():
         Puts data into the update queue for the user so the client can serve it to them
 
         """
+        if username is None:
+            return
         active_sessions = [i for i in sessions if sessions[i]["username"] == username]
-        map(lambda s: sessions[s]["updates"].put(update_data), active_sessions)
+        for active_session in active_sessions:
+            sessions[active_session]["updates"].put(update_data)
 
     def monitor(self, db):
         """
@@ -92,33 +126,50 @@ class sessions_monitor():
 
         """
         global events
+        last_sample = 0
         while True:
             time.sleep(0.1)
+            current_second = int(time.time())
+            if current_second != last_sample:
+                #Sample the gauges once a second
+                last_sample = current_second
+                metrics.record("sessions", len(sessions))
+                metrics.record("scheduler_backlog", len(events))
             if events:
-                for event in events:
-                    current_time = time.time()
-                    if event["time"] <= current_time:
-                        log.debug("Processing event {0}".format(event))
-                        event_type = event["type"]
-                        if event_type == "notification":
-                            username = event["username"]
-                            #Active sessions for the user
-                            sessions_monitor.update_sessions(username, event)
-                            update_data = {"type": "notification", "text": event["value"], "data": event}
-                            sessions_monitor.update_sessions(username, update_data)
-                            notification_thread = threading.Thread(
-                                  target=notification.send_notification, args=(event, db))
-                            notification_thread.start()
-                        elif event_type == "url":
-                            response = requests.get(event["value"]).text
-                            update_data = {"type": "event", "text": response, "data": event}
-                            username = event["username"]
-                            sessions_monitor.update_sessions(username, update_data)
-                        elif event_type == "function":
+                current_time = time.time()
+                for event in [e for e in events if e["time"] <= current_time]:
+                    log.debug("Processing event {0}".format(event))
+                    event_type = event["type"]
+                    if event_type == "notification":
+                        username = event["username"]
+                        #Active sessions for the user. The event itself goes out as the update's data
+                        update_data = {"type": "notification", "text": event["value"], "data": dict(event)}
+                        sessions_monitor.update_sessions(username, update_data)
+                        notification_thread = threading.Thread(
+                              target=notification.send_notification, args=(event, db))
+                        notification_thread.start()
+                    elif event_type == "url":
+                        response = requests.get(event["value"]).text
+                        update_data = {"type": "event", "text": response, "data": event}
+                        username = event["username"]
+                        sessions_monitor.update_sessions(username, update_data)
+                    elif event_type == "function":
+                        try:
                             response = event["value"]()
-                            update_data = {"type": "event", "text": response, "data": event}
-                            username = event["username"]
-                            sessions_monitor.update_sessions(username, update_data)
+                        except Exception as function_error:
+                            log.error(":EVENTS:Error {0} in function event {1}".format(function_error, event["uid"]))
+                            response = None
+                        #The function itself can't be serialized for the client
+                        event_data = dict((k, v) for k, v in event.items() if k != "value")
+                        update_data = {"type": "event", "text": response, "data": event_data}
+                        username = event["username"]
+                        sessions_monitor.update_sessions(username, update_data)
+                    if event.get("interval"):
+                        #Recurring internal functions are rescheduled instead of removed
+                        event["time"] += event["interval"]
+                    elif event.get("recurrence") in recurrence_intervals:
+                        reschedule(event, db)
+                    else:
                         events.remove(event)
 
 
@@ -128,13 +179,133 @@ class sessions_monitor():
 
         :param db:
         """
+        global event_horizon
+        global event_chunk_size
+        event_horizon = configuration_data.get("event_horizon", event_horizon)
+        event_chunk_size = configuration_data.get("event_chunk_size", event_chunk_size)
         #Pull pending notifications
-        db.query('delete from `events` where time <= {0}'.format(time.time()))
-        for i in db['events'].all():
-            events.append(i)
+        repository.delete_events_before(db, time.time())
+        load_events(db)
+        #Page in later events as the horizon advances
+        schedule_function(lambda: start_load_events(db), max(event_horizon/4, 1), "load_events")
         sessions_thread = threading.Thread(target=self.monitor, args=(db,))
         sessions_thread.start()
 
+def load_events(db):
+    """
+    Load the stored events that are due before the event horizon and haven't been loaded yet
+
+    :param db:
+    :return a summary of the load:
+    """
+    global loaded_until
+    with events_lock:
+        load_until = time.time()+event_horizon
+        #Make sure events queued for the database are there before reading the window
+        write_behind.flush()
+        loaded_uids = set(event["uid"] for event in events)
+        loaded = 0
+        for event_row in repository.stream_events(db, loaded_until, load_until, event_chunk_size):
+            if event_row.get("recurrence") in recurrence_intervals and event_row["time"] <= time.time():
+                #Skip the occurrences that were missed while the server was down
+                event_row["time"] = next_occurrence(event_row, time.time())
+                write_behind.upsert(db, "events", event_row, ['uid'])
+                if event_row["time"] > load_until:
+                    continue
+            if event_row["uid"] not in loaded_uids:
+                events.append(event_row)
+                loaded += 1
+        loaded_until = load_until
+    log.info(":EVENTS:Loaded {0} events due before {1}".format(loaded, load_until))
+    return "Loaded {0} events".format(loaded)
+
+def start_load_events(db):
+    """
+    Run load_events off the scheduler thread
+
+    :param db:
+    """
+    load_thread = threading.Thread(target=load_events, args=(db,))
+    load_thread.daemon = True
+    load_thread.start()
+    return "Started loading events"
+
+def add_event(event, db):
+    """
+    Schedule an event. Events inside the horizon are kept in memory, later ones are stored until they're paged in
+
+    :param event:
+    :param db:
+    """
+    with events_lock:
+        if event["time"] <= loaded_until or event["type"] == "function":
+            events.append(event)
+        else:
+            write_behind.upsert(db, "events", event, ['uid'])
+
+def next_occurrence(event, now):
+    """
+    Get the first occurrence of a recurring event after a time
+
+    :param event:
+    :param now: Epoch time
+    :return epoch time:
+    """
+    interval = recurrence_intervals[event["recurrence"]]
+    if event["time"] > now:
+        return event["time"]
+    return event["time"]+(int((now-event["time"]) // interval)+1)*interval
+
+def reschedule(event, db):
+    """
+    Move a recurring event to its next occurrence. Only the next occurrence is ever scheduled, and it leaves
+    memory until it's paged in again if it's past the horizon
+
+    :param event:
+    :param db:
+    """
+    with events_lock:
+        event["time"] = next_occurrence(event, time.time())
+        write_behind.upsert(db, "events", dict(event), ['uid'])
+        if event["time"] > loaded_until:
+            events.remove(event)
+
+def add_events(new_events, db):
+    """
+    Store many events in one transaction, keeping the ones inside the horizon in memory as well
+
+    :param new_events: List of events
+    :param db:
+    """
+    with events_lock:
+        db.begin()
+        try:
+            db["events"].insert_many(new_events)
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        events.extend([event for event in new_events if event["time"] <= loaded_until])
+
+def schedule_function(function, interval, uid, delay=None):
+    """
+    Run a function on the event scheduler every interval seconds. The function runs on the scheduler thread, so
+    anything slow should be handed off to a thread of its own
+
+    :param function: Called with no arguments. Its return value is logged with the event
+    :param interval: Seconds between runs
+    :param uid: Unique id of the scheduled function
+    :param delay: Seconds until the first run, defaults to the interval
+    """
+    events.append({
+        "username": None,
+        "time": time.time()+(interval if delay is None else delay),
+        "interval": interval,
+        "value": function,
+        "type": "function",
+        "uid": uid
+    })
+
 def initialize(db):
     """
     Run the plugin loader
@@ -0,0 +1,237 @@
+#Builtin imports
+import logging
+import threading
+import time
+import hmac
+import hashlib
+import base64
+import uuid
+
+#External imports
+import bcrypt
+try:
+    #Runs the hashing on real threads and lets the waiting greenlet yield while it works
+    from gevent.threadpool import ThreadPoolExecutor
+except ImportError:
+    from concurrent.futures import ThreadPoolExecutor
+
+#Internal imports
+import core.repository as repository
+
+log = logging.getLogger()
+
+db = None
+
+secret_key = None
+
+token_ttl = 3600
+
+hash_pool = None
+
+pool_slots = None
+
+verified_tokens = {}
+
+#Expiry times of revoked tokens, by the sha256 hash of the token
+revoked_tokens = {}
+
+tokens_lock = threading.Lock()
+
+#The token caches are pruned at most this often, from issue_token and verify_token
+prune_interval = 60
+
+last_prune = 0
+
+
+class AuthBusy(Exception):
+    '''Raised when the password hashing pool is saturated'''
+    pass
+
+
+def initialize(configuration_data, database=None):
+    """
+    Start the password hashing pool, load the token signing settings, and load the revocations of tokens that
+    haven't expired yet
+
+    :param configuration_data:
+    :param database: Optional, revocations are only kept in memory without one
+    """
+    global db
+    global secret_key
+    global token_ttl
+    global hash_pool
+    global pool_slots
+    secret_key = configuration_data["secret_key"].encode('utf8')
+    token_ttl = configuration_data.get("auth_token_ttl", 3600)
+    workers = configuration_data.get("auth_workers", 2)
+    max_pending = configuration_data.get("auth_max_pending", 32)
+    log.info(":AUTH:Starting password hashing pool with {0} workers and {1} pending slots".format(
+        workers, max_pending))
+    hash_pool = ThreadPoolExecutor(max_workers=workers)
+    pool_slots = threading.BoundedSemaphore(max_pending)
+    db = database
+    if db is not None:
+        with tokens_lock:
+            for revocation_row in repository.active_revocations(db, time.time()):
+                revoked_tokens.update({revocation_row["token_hash"]: revocation_row["expires"]})
+        log.info(":AUTH:Loaded {0} token revocations".format(len(revoked_tokens)))
+
+
+def _run_in_pool(function, *args):
+    """
+    Run a bcrypt function on the hashing pool and wait for the result
+
+    :param function:
+    :param args:
+    :return function result:
+    """
+    if not pool_slots.acquire(False):
+        log.warning(":AUTH:Password hashing pool is full, rejecting request")
+        raise AuthBusy()
+    try:
+        return hash_pool.submit(function, *args).result()
+    finally:
+        pool_slots.release()
+
+
+def hash_password(password):
+    """
+    Hash a password with bcrypt on the hashing pool
+
+    :param password:
+    :return hashed password:
+    """
+    return _run_in_pool(bcrypt.hashpw, password.encode('utf8'), bcrypt.gensalt())
+
+
+def check_password(password, db_hash):
+    """
+    Check a password against a stored bcrypt hash on the hashing pool
+
+    :param password:
+    :param db_hash:
+    :return boolean:
+    """
+    return _run_in_pool(bcrypt.checkpw, password.encode('utf8'), db_hash.encode('utf8'))
+
+
+def _sign(payload):
+    """
+    Sign a token payload with the server secret key
+
+    :param payload:
+    :return hex signature:
+    """
+    return hmac.new(secret_key, payload.encode('utf8'), hashlib.sha256).hexdigest()
+
+
+def _token_hash(token):
+    """
+    :param token:
+    :return sha256 hex digest of the token, which revocations are stored by:
+    """
+    return hashlib.sha256(token.encode('utf8')).hexdigest()
+
+
+def _maybe_prune(now):
+    """
+    Prune the token caches if they haven't been pruned for prune_interval seconds
+
+    :param now:
+    """
+    global last_prune
+    if now-last_prune >= prune_interval:
+        last_prune = now
+        prune_tokens()
+
+
+def issue_token(username):
+    """
+    Issue a signed, short lived token for a user that has already authenticated
+
+    :param username:
+    :return token string:
+    """
+    now = time.time()
+    _maybe_prune(now)
+    expires = int(now) + token_ttl
+    raw_payload = "{0}|{1}|{2}".format(username, expires, uuid.uuid4().hex)
+    payload = base64.urlsafe_b64encode(raw_payload.encode('utf8')).decode('utf8').rstrip('=')
+    token = "{0}.{1}".format(payload, _sign(payload))
+    with tokens_lock:
+        verified_tokens.update({token: (username, expires)})
+    log.debug(":AUTH:{0}:Issued token expiring at {1}".format(username, expires))
+    return token
+
+
+def verify_token(token):
+    """
+    Check a token, first against the in memory cache and then against its signature
+
+    :param token:
+    :return the username the token belongs to, or None if it's invalid:
+    """
+    now = time.time()
+    if _token_hash(token) in revoked_tokens:
+        return None
+    cached = verified_tokens.get(token)
+    if cached:
+        username, expires = cached
+        if expires > now:
+            return username
+        with tokens_lock:
+            verified_tokens.pop(token, None)
+        return None
+    #Tokens issued before a restart aren't cached, so fall back to checking the signature
+    try:
+        payload, signature = token.split(".")
+        if not hmac.compare_digest(_sign(payload), signature):
+            return None
+        padded = payload + "=" * (-len(payload) % 4)
+        #Usernames can contain the separator, but the expiry and nonce can't
+        username, expires, nonce = base64.urlsafe_b64decode(padded.encode('utf8')).decode('utf8').rsplit("|", 2)
+        expires = int(expires)
+    except (ValueError, TypeError):
+        return None
+    if expires <= now:
+        return None
+    _maybe_prune(now)
+    with tokens_lock:
+        verified_tokens.update({token: (username, expires)})
+    return username
+
+
+def revoke_token(token):
+    """
+    Revoke a token before it expires. With a database the revocation is stored, so it survives a restart
+
+    :param token:
+    """
+    with tokens_lock:
+        cached = verified_tokens.pop(token, None)
+    #Keep the revocation until the token would have expired anyway
+    expires = cached[1] if cached else time.time()+token_ttl
+    token_hash = _token_hash(token)
+    with tokens_lock:
+        revoked_tokens.update({token_hash: expires})
+    if db is not None:
+        db["revoked_tokens"].upsert(dict(token_hash=token_hash, expires=expires), ["token_hash"])
+    prune_tokens()
+
+
+def prune_tokens():
+    """
+    Remove expired tokens and revocations from the cache and the database
+
+    """
+    now = time.time()
+    with tokens_lock:
+        for token in [t for t, data in verified_tokens.items() if data[1] <= now]:
+            del verified_tokens[token]
+        for token_hash in [t for t, expires in revoked_tokens.items() if expires <= now]:
+            del revoked_tokens[token_hash]
+    if db is not None:
+        try:
+            repository.delete_revocations_before(db, now)
+        except Exception as prune_error:
+            log.error(":AUTH:Error {0} while pruning stored token revocations".format(prune_error))
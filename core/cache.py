@@ -0,0 +1,279 @@
+#Builtin imports
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+#Internal imports
+import core.metrics as metrics
+
+log = logging.getLogger()
+
+#Every named cache, so the admin pages can report on them
+caches = {}
+
+caches_lock = threading.Lock()
+
+
+class TTLCache():
+    '''
+    A bounded cache whose entries go stale after ttl seconds. Stale entries are kept until they're evicted, so
+    callers can serve them while they refresh in the background. When the cache is full the least recently used
+    entry is evicted
+    '''
+    def __init__(self, name, ttl, max_size=1000):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key, now=None):
+        """
+        Look up an entry, fresh or stale
+
+        :param key:
+        :param now: Epoch time, defaults to the current time
+        :return (value, fresh), or (None, False) when there's no entry:
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                metrics.increment("cache_miss:{0}".format(self.name))
+                return None, False
+            #Reinsert to mark the entry as recently used
+            del self.entries[key]
+            self.entries[key] = entry
+            value, stored_at, ttl = entry
+            fresh = now < stored_at+ttl
+            if fresh:
+                self.hits += 1
+                metrics.increment("cache_hit:{0}".format(self.name))
+            else:
+                self.stale_hits += 1
+                metrics.increment("cache_stale:{0}".format(self.name))
+            return value, fresh
+
+    def get(self, key, now=None):
+        """
+        :param key:
+        :param now:
+        :return the fresh value for the key, or None:
+        """
+        value, fresh = self.lookup(key, now)
+        return value if fresh else None
+
+    def set(self, key, value, stored_at=None, ttl=None):
+        """
+        Store a value
+
+        :param key:
+        :param value:
+        :param stored_at: Epoch time the value was fetched, defaults to the current time
+        :param ttl: Seconds the value stays fresh, defaults to the cache's ttl
+        """
+        if stored_at is None:
+            stored_at = time.time()
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, stored_at, ttl)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def keys(self):
+        """
+        :return list of the keys with an entry, fresh or stale, least recently used first:
+        """
+        with self.lock:
+            return list(self.entries.keys())
+
+    def expires_at(self, key):
+        """
+        Check when an entry goes stale, without counting it as a lookup
+
+        :param key:
+        :return epoch time the entry goes stale, or None when there's no entry:
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, stored_at, ttl = entry
+        return stored_at+ttl
+
+    def delete(self, key):
+        """
+        :param key:
+        :return whether there was an entry to delete:
+        """
+        with self.lock:
+            return self.entries.pop(key, None) is not None
+
+    def purge(self, prefix):
+        """
+        Remove every entry whose key starts with a prefix
+
+        :param prefix:
+        :return the number of entries removed:
+        """
+        with self.lock:
+            purged_keys = [key for key in self.entries if str(key).startswith(prefix)]
+            for key in purged_keys:
+                del self.entries[key]
+            return len(purged_keys)
+
+    def dump(self, now=None):
+        """
+        Get the fresh entries in a form that can be stored as json
+
+        :param now:
+        :return list of [key, value, stored_at, ttl]:
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            return [[key, value, stored_at, ttl] for key, (value, stored_at, ttl) in self.entries.items()
+                    if now < stored_at+ttl]
+
+    def load(self, entries):
+        """
+        Add entries from dump
+
+        :param entries:
+        """
+        for key, value, stored_at, ttl in entries:
+            self.set(key, value, stored_at=stored_at, ttl=ttl)
+
+    def clear(self):
+        """
+        Remove every entry
+
+        :return the number of entries removed:
+        """
+        with self.lock:
+            removed = len(self.entries)
+            self.entries.clear()
+            return removed
+
+    def stats(self):
+        """
+        :return dict of cache statistics:
+        """
+        with self.lock:
+            lookups = self.hits+self.stale_hits+self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                #Stale hits are reported separately, since callers that use get() treat them as misses
+                "hit_ratio": float(self.hits)/lookups if lookups else 0.0,
+                "stale_ratio": float(self.stale_hits)/lookups if lookups else 0.0
+            }
+
+
+class SingleFlight():
+    '''
+    Collapses concurrent calls for the same key into one. The first caller runs the function and everyone who
+    asks for the key meanwhile waits for and shares its result
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, function, *args):
+        """
+        Run a function for a key, or wait for the run that's already in progress
+
+        :param key:
+        :param function:
+        :param args:
+        :return the function's result. Exceptions are raised in every waiting caller:
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self.calls[key] = call
+        if not leader:
+            call["done"].wait()
+        else:
+            try:
+                call["result"] = function(*args)
+            except Exception as call_error:
+                call["error"] = call_error
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call["done"].set()
+        if call["error"] is not None:
+            raise call["error"]
+        return call["result"]
+
+    def in_flight(self, key):
+        """
+        :param key:
+        :return whether a call for the key is running:
+        """
+        with self.lock:
+            return key in self.calls
+
+    def do_async(self, key, function, *args):
+        """
+        Run a function for a key in the background, unless a call for the key is already running
+
+        :param key:
+        :param function:
+        :param args:
+        :return whether a new call was started:
+        """
+        if self.in_flight(key):
+            return False
+
+        def run():
+            try:
+                self.do(key, function, *args)
+            except Exception as call_error:
+                log.error(":CACHE:Error {0} in background call for {1}".format(call_error, key))
+        call_thread = threading.Thread(target=run)
+        call_thread.daemon = True
+        call_thread.start()
+        return True
+
+
+def get_cache(name, ttl, max_size=1000):
+    """
+    Get a named cache, creating it the first time
+
+    :param name:
+    :param ttl:
+    :param max_size:
+    :return TTLCache:
+    """
+    with caches_lock:
+        if name not in caches:
+            caches[name] = TTLCache(name, ttl, max_size)
+        return caches[name]
+
+
+def stats():
+    """
+    :return dict of statistics for every named cache:
+    """
+    with caches_lock:
+        named_caches = list(caches.items())
+    return dict((name, named_cache.stats()) for name, named_cache in named_caches)
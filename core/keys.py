@@ -0,0 +1,160 @@
+#Builtin imports
+import logging
+import threading
+import heapq
+import time
+import datetime
+
+#Internal imports
+import core.repository as repository
+import core.write_behind as write_behind
+
+log = logging.getLogger()
+
+#How often, in seconds, the keys table is reloaded to pick up added or changed keys
+reload_interval = 300
+
+rotator = None
+
+rotator_lock = threading.Lock()
+
+
+class KeysExhausted(Exception):
+    '''Raised when every key of a type has reached its maximum uses'''
+    pass
+
+
+class KeyRotator():
+    '''
+    Hands out API keys from memory. Keys of each type are kept in a heap ordered by whether they're used up and
+    then by uses, so the least used valid key is always on top. Uses are counted in memory and written back to the
+    keys table through the write behind buffer, which merges repeated updates to a key into one batched write
+    '''
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.heaps = {}
+        self.month = None
+        with self.lock:
+            self._load()
+            self._check_month()
+
+    def _load(self):
+        """
+        Load every key from the keys table. Must be called with the lock held.
+        Uses counted in memory that might not have been written yet are kept
+
+        """
+        counted_uses = {}
+        for key_type, key_heap in self.heaps.items():
+            for entry in key_heap:
+                counted_uses[(key_type, entry[2])] = entry[1]
+        heaps = {}
+        for key_row in repository.all_keys(self.db):
+            key_row["uses"] = max(key_row["uses"], counted_uses.get((key_row["type"], key_row["num"]), 0))
+            used_up = key_row["uses"] > key_row["max_uses"]
+            heaps.setdefault(key_row["type"], []).append([used_up, key_row["uses"], key_row["num"], key_row])
+        for key_heap in heaps.values():
+            heapq.heapify(key_heap)
+        self.heaps = heaps
+        log.info(":KEYS:Loaded keys for types {0}".format(list(heaps.keys())))
+
+    def _check_month(self):
+        """
+        Reset key uses at the start of every month. Must be called with the lock held
+
+        """
+        month = datetime.date.today().strftime("%Y-%m")
+        if month == self.month:
+            return
+        reset_row = self.db['vars'].find_one(name="keys_reset_month")
+        if not reset_row or reset_row["value"] == month:
+            #Without a record of the last reset, assume the stored uses belong to this month
+            if not reset_row:
+                self.db['vars'].upsert(dict(name="keys_reset_month", value=month), ['name'])
+            self.month = month
+            return
+        log.info(":KEYS:Resetting key uses for {0}".format(month))
+        #The reset is written straight away, so that a reload can't bring back last month's uses
+        write_behind.flush()
+        self.db.begin()
+        try:
+            for key_type, key_heap in self.heaps.items():
+                for entry in key_heap:
+                    entry[0] = False
+                    entry[1] = 0
+                    entry[3]["uses"] = 0
+                    self.db['keys'].update(dict(type=key_type, num=entry[2], uses=0), ['type', 'num'])
+                heapq.heapify(key_heap)
+            self.db['vars'].upsert(dict(name="keys_reset_month", value=month), ['name'])
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        self.month = month
+
+    def use(self, key_type):
+        """
+        Get the least used valid key of a type and count a use against it
+
+        :param key_type:
+        :return key row:
+        """
+        with self.lock:
+            self._check_month()
+            if key_type not in self.heaps:
+                #Pick up a type that was added since the last reload. Missing types are cached as empty until then
+                key_heap = [[row["uses"] > row["max_uses"], row["uses"], row["num"], row]
+                            for row in repository.keys_by_type(self.db, key_type)]
+                heapq.heapify(key_heap)
+                self.heaps[key_type] = key_heap
+            key_heap = self.heaps[key_type]
+            if not key_heap or key_heap[0][0]:
+                raise KeysExhausted("No usable {0} keys".format(key_type))
+            entry = key_heap[0]
+            key_row = entry[3]
+            entry[1] += 1
+            entry[0] = entry[1] > key_row["max_uses"]
+            key_row["uses"] = entry[1]
+            heapq.heapreplace(key_heap, entry)
+            write_behind.upsert(self.db, "keys", dict(type=key_type, num=entry[2], uses=entry[1]), ['type', 'num'])
+            return key_row
+
+    def reload(self):
+        """
+        Pick up any keys that were added or changed
+
+        """
+        with self.lock:
+            self._load()
+
+    def reload_loop(self):
+        """
+        Reload the keys every reload_interval seconds
+
+        """
+        while True:
+            time.sleep(reload_interval)
+            try:
+                self.reload()
+            except Exception as reload_error:
+                log.error(":KEYS:Error {0} while reloading keys".format(reload_error))
+
+
+def get_rotator(db):
+    """
+    Get the key rotator, starting it and its reload thread the first time it's used
+
+    :param db:
+    :return KeyRotator:
+    """
+    global rotator
+    if rotator is None:
+        with rotator_lock:
+            if rotator is None:
+                new_rotator = KeyRotator(db)
+                reload_thread = threading.Thread(target=new_rotator.reload_loop)
+                reload_thread.daemon = True
+                reload_thread.start()
+                rotator = new_rotator
+    return rotator
@@ -0,0 +1,244 @@
+#Builtin imports
+import logging
+import threading
+import time
+
+log = logging.getLogger()
+
+counters = {}
+
+counters_lock = threading.Lock()
+
+
+def increment(name, amount=1):
+    """
+    Increment a named counter
+
+    :param name:
+    :param amount:
+    """
+    with counters_lock:
+        counters[name] = counters.get(name, 0) + amount
+
+
+def get(name):
+    """
+    Get the current value of a counter
+
+    :param name:
+    :return counter value:
+    """
+    return counters.get(name, 0)
+
+
+def snapshot():
+    """
+    Copy all of the counters
+
+    :return dict of counter names and values:
+    """
+    with counters_lock:
+        return dict(counters)
+
+
+class RateWindows():
+    '''
+    Event counts over sliding 1, 5, and 15 minute windows, kept in one second buckets.
+    Running sums are maintained as buckets expire, so reading the rates doesn't scan the buckets
+    '''
+    windows = (60, 300, 900)
+
+    def __init__(self):
+        self.size = max(self.windows)
+        self.buckets = [0] * self.size
+        self.sums = [0] * len(self.windows)
+        self.last = int(time.time())
+        self.lock = threading.Lock()
+
+    def _advance(self, now):
+        """
+        Move the windows forward to the current second. Must be called with the lock held
+
+        :param now:
+        """
+        if now - self.last >= self.size:
+            self.buckets = [0] * self.size
+            self.sums = [0] * len(self.windows)
+            self.last = now
+            return
+        while self.last < now:
+            self.last += 1
+            for i, window in enumerate(self.windows):
+                self.sums[i] -= self.buckets[(self.last - window) % self.size]
+            self.buckets[self.last % self.size] = 0
+
+    def record(self, amount=1, now=None):
+        """
+        Record events in the current second
+
+        :param amount:
+        :param now:
+        """
+        now = int(now if now is not None else time.time())
+        with self.lock:
+            self._advance(now)
+            self.buckets[now % self.size] += amount
+            for i in range(len(self.sums)):
+                self.sums[i] += amount
+
+    def counts(self, now=None):
+        """
+        Get the number of events in each window
+
+        :param now:
+        :return dict of window length in minutes and event count:
+        """
+        now = int(now if now is not None else time.time())
+        with self.lock:
+            self._advance(now)
+            return dict(("{0}m".format(window // 60), self.sums[i]) for i, window in enumerate(self.windows))
+
+    def rates(self, now=None):
+        """
+        Get the average events per minute over each window
+
+        :param now:
+        :return dict of window length in minutes and events per minute:
+        """
+        window_counts = self.counts(now)
+        return dict((name, window_counts[name] / float(name[:-1])) for name in window_counts)
+
+
+#Name, seconds per slot, and number of slots for each time series resolution
+resolutions = (
+    ("second", 1, 600),
+    ("minute", 60, 1440),
+    ("hour", 3600, 168)
+)
+
+#Upper bounds in milliseconds of the histogram buckets used for percentiles
+latency_buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, float("inf"))
+
+series = {}
+
+
+class TimeSeries():
+    '''
+    A fixed memory time series. Every value is rolled into per second, per minute, and per hour ring buffers,
+    and each slot keeps the count, sum, max, and last value recorded in it. Series that track latency also keep
+    a small histogram per slot so percentiles can be estimated
+    '''
+    def __init__(self, percentiles=False):
+        self.percentiles = percentiles
+        self.lock = threading.Lock()
+        self.rings = {}
+        for name, step, slots in resolutions:
+            self.rings[name] = {"step": step, "slots": slots, "starts": [None] * slots, "data": [None] * slots}
+
+    def record(self, value=1, now=None):
+        """
+        Record a value
+
+        :param value:
+        :param now:
+        """
+        if now is None:
+            now = time.time()
+        if self.percentiles:
+            bucket = 0
+            while value > latency_buckets[bucket]:
+                bucket += 1
+        with self.lock:
+            for ring in self.rings.values():
+                step = ring["step"]
+                slot_start = int(now // step) * step
+                i = (slot_start // step) % ring["slots"]
+                if ring["starts"][i] != slot_start:
+                    ring["starts"][i] = slot_start
+                    histogram = [0] * len(latency_buckets) if self.percentiles else None
+                    ring["data"][i] = [0, 0, value, value, histogram]
+                slot = ring["data"][i]
+                slot[0] += 1
+                slot[1] += value
+                slot[2] = max(slot[2], value)
+                slot[3] = value
+                if self.percentiles:
+                    slot[4][bucket] += 1
+
+    @staticmethod
+    def _percentile(histogram, count, fraction):
+        """
+        Estimate a percentile from a slot histogram
+
+        :param histogram:
+        :param count:
+        :param fraction:
+        :return the upper bound of the bucket the percentile falls in:
+        """
+        target = count * fraction
+        seen = 0
+        for i, bucket_count in enumerate(histogram):
+            seen += bucket_count
+            if seen >= target:
+                return latency_buckets[i] if i < len(latency_buckets) - 1 else latency_buckets[i - 1]
+        return latency_buckets[-2]
+
+    def history(self, resolution="minute", points=60, now=None):
+        """
+        Get the most recent points of the series
+
+        :param resolution: second, minute, or hour
+        :param points:
+        :param now:
+        :return list of points, oldest first:
+        """
+        if now is None:
+            now = time.time()
+        ring = self.rings[resolution]
+        step = ring["step"]
+        points = min(points, ring["slots"])
+        current_start = int(now // step) * step
+        history_points = []
+        with self.lock:
+            for n in range(points - 1, -1, -1):
+                slot_start = current_start - n * step
+                i = (slot_start // step) % ring["slots"]
+                point = {"time": slot_start, "count": 0, "sum": 0, "avg": None, "max": None, "last": None}
+                if ring["starts"][i] == slot_start:
+                    count, total, maximum, last, histogram = ring["data"][i]
+                    point.update({"count": count, "sum": total, "avg": total / float(count),
+                                  "max": maximum, "last": last})
+                    if histogram:
+                        for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+                            point[name] = self._percentile(histogram, count, fraction)
+                history_points.append(point)
+        return history_points
+
+
+def record(name, value=1, percentiles=False, now=None):
+    """
+    Record a value in a named time series, creating it if needed
+
+    :param name:
+    :param value:
+    :param percentiles: Whether the series should keep histograms for percentiles
+    :param now:
+    """
+    time_series = series.get(name)
+    if time_series is None:
+        time_series = series.setdefault(name, TimeSeries(percentiles))
+    time_series.record(value, now)
+
+
+def history(name, resolution="minute", points=60):
+    """
+    Get the history of a named time series
+
+    :param name:
+    :param resolution:
+    :param points:
+    :return list of points, or None if the series doesn't exist:
+    """
+    if name not in series.keys():
+        return None
+    return series[name].history(resolution, points)
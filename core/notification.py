@@ -5,6 +5,7 @@ import logging
 import requests
 #Internal imports
 import tools
+import core.repository as repository
 
 log = logging.getLogger()
 
@@ -40,7 +41,7 @@ class send_notification():
         :param db:
         """
         username = notification['username']
-        user_table = db['users'].find_one(username=username)
+        user_table = repository.user_by_username(db, username)
         user_handlers_json = user_table['notifications']
         user_notifications = json.loads(user_handlers_json)
         log.debug("Notifcation handlers for user {0} are {1}".format(
@@ -59,3 +59,13 @@ def parse(command_data, session):
     log.info("Finished parsing event_data, sending it into events queue")
     log.debug("Event_data is {0}".format(event_data))
     return event_data
+
+def vector(text):
+    """
+    Get the word vector of a text, the average of its tokens' vectors. Only the tokenizer is run, so it's much
+    faster than parsing the text
+
+    :param text:
+    :return vector:
+    """
+    return nlp.tokenizer(text).vector
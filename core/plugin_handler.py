@@ -8,6 +8,12 @@ import traceback
 #External imports
 import importlib
 
+#Internal imports
+import core.repository as repository
+import core.parser as parser
+import core.vectors as vectors
+import core.trigrams as trigrams
+
 log = logging.getLogger()
 
 dir_path = 'core/plugins'
@@ -18,6 +24,8 @@ command_plugins = {}
 
 default_plugin_data = None
 
+phrase_indexes = {}
+
 
 class subscriptions():
     '''
@@ -65,7 +73,6 @@ class subscriptions():
         :param db:
         :return a response object:
         """
-        user_data = db["users"]
         time.sleep(0.1)
         log.debug("Processing event {0}".format(event))
         #If the queue is empty, pass
@@ -76,7 +83,7 @@ class subscriptions():
         username = event["session"]["username"]
         log.info("Processing event with command {0}, user {1}".format(
             event_command, username))
-        user_table = user_data.find_one(username=username)
+        user_table = repository.user_by_username(db, username)
         event.update({"user_table":user_table})
         event.update({"username":username})
         found_plugins = []
@@ -100,6 +107,7 @@ class subscriptions():
         if plugin_len == 1:
             plugin = found_plugins[0]
             log.info("Running plugin {0}".format(plugin))
+            event.update({"plugin": plugin["name"]})
             plugin_function = plugin['function']
             #Call the plugin
             return self.call_plugin(plugin_function,event)
@@ -125,6 +133,7 @@ class subscriptions():
                     break
             if default_plugin_func:
                 #Call the default plugin
+                event.update({"plugin": default_plugin})
                 return self.call_plugin(default_plugin_func, event)
             else:
                 error_message = "Couldn't find defafult plugin {0} in plugin list {1}".format(
@@ -169,6 +178,45 @@ def subscribe(subscription_data):
         return f
     return wrap
 
+class PhraseIndex():
+    '''
+    A fixed set of phrases a plugin compares commands against. The phrases are embedded once when they're
+    registered, so matching a command is a hash lookup for exact phrases and one matrix-vector product otherwise
+    '''
+    def __init__(self, name, phrases):
+        self.name = name
+        self.exact = dict((trigrams.normalize(phrase), phrase) for phrase in phrases)
+        self.index = vectors.VectorIndex.build(phrases, parser.vector)
+
+    def best_match(self, doc, threshold=0.0):
+        """
+        Find the phrase most similar to a parsed command
+
+        :param doc: The command's spaCy doc, usually event["doc"]
+        :param threshold: Minimum similarity of a match
+        :return (phrase, similarity), or None if no phrase is similar enough:
+        """
+        exact_phrase = self.exact.get(trigrams.normalize(doc.text))
+        if exact_phrase is not None:
+            return exact_phrase, 1.0
+        matches = self.index.top_k(doc.vector, 1)
+        if matches and matches[0][1] >= threshold:
+            return matches[0]
+        return None
+
+def register_phrases(name, phrases):
+    """
+    Register a plugin's phrase corpus
+
+    :param name: Name of the corpus, usually the plugin's name
+    :param phrases: List of phrases
+    :return PhraseIndex:
+    """
+    log.info("Registering {0} phrases for {1}".format(len(phrases), name))
+    phrase_index = PhraseIndex(name, list(phrases))
+    phrase_indexes[name] = phrase_index
+    return phrase_index
+
 def load(dir_path, DB):
     """
     Run the plugin loader on processed plugins
@@ -1,4 +1,4 @@
-from core.plugin_handler import subscribe
+from core.plugin_handler import subscribe, register_phrases
 import logging
 
 log = logging.getLogger()
@@ -16,19 +16,15 @@ easter_eggs = {
     "Who is your master?": "I was created by Will Beddow (will@willbeddow.com)"
 }
 
+egg_phrases = register_phrases("easter_eggs", easter_eggs.keys())
+
 def egg_hunt(event):
-    scores = [event["doc"].similarity(event["parse"](x)) for x in easter_eggs]
-    return max(scores) >= 0.96
+    return egg_phrases.best_match(event["doc"], 0.96) is not None
 
 @subscribe({"name": "easter_eggs", "check": egg_hunt})
 def egg(event):
-    scores = {}
-    for x in easter_eggs:
-        x_parse = event["parse"](x)
-        scores.update({
-            event["doc"].similarity(x_parse): easter_eggs[x]
-        })
-    most_compatible = scores[max(scores)]
+    phrase, similarity = egg_phrases.best_match(event["doc"])
+    most_compatible = easter_eggs[phrase]
     log.debug("Query {0} activated easter egg {1}".format(event["command"], most_compatible))
     response = {"type": "success", "text": most_compatible, "data": {}}
     return response
@@ -1,15 +1,68 @@
 #Internal imports
 from core.plugin_handler import subscribe
+import core.parser as parser
+import core.vectors as vectors
+import core.trigrams as trigrams
+import core.metrics as metrics
 import tools
 
 #Builtin imports
 import logging
 import json
 import difflib
+import os
+import threading
+import time
 
-shows = json.loads(open("core/plugin_files/shows.json").read())
 log = logging.getLogger()
 
+shows_file = "core/plugin_files/shows.json"
+
+#The title vectors are saved here, so only titles added to shows.json need vectors computed after a restart
+index_path = "core/plugin_files/shows_vectors"
+
+shows = {}
+
+title_index = None
+
+title_trigrams = trigrams.TrigramIndex("netflix")
+
+#Number of trigram candidates passed on to the vector scoring
+vector_candidates = 50
+
+shows_mtime = None
+
+catalog_lock = threading.Lock()
+
+def load_catalog():
+    '''Load shows.json if it changed, and bring the title vector index up to date with it'''
+    global shows
+    global title_index
+    global shows_mtime
+    mtime = os.path.getmtime(shows_file)
+    if mtime == shows_mtime:
+        return
+    with catalog_lock:
+        if mtime == shows_mtime:
+            return
+        new_shows = json.loads(open(shows_file).read())
+        if title_index is None:
+            new_index = vectors.VectorIndex.load(index_path) or vectors.VectorIndex()
+        else:
+            #Lookups keep using the live index, so update a copy and swap it in with one assignment
+            new_index = title_index.copy()
+        added, removed = new_index.update(new_shows.keys(), parser.vector)
+        if added or removed:
+            log.info("Updated netflix title index, {0} titles added and {1} removed".format(added, removed))
+            new_index.save(index_path)
+            new_index = vectors.VectorIndex.load(index_path)
+        shows = new_shows
+        title_index = new_index
+        title_trigrams.update(new_shows.keys())
+        shows_mtime = mtime
+
+load_catalog()
+
 def is_netflix(event):
     event_doc = event["doc"]
     return "netflix" in [word.orth_.lower() for word in event_doc]
@@ -30,20 +83,27 @@ def main(event):
         }
     log.debug("In netflix module, found work {0}".format(work))
     #Find the show in a json file keyed with show names and that has show ids
-    sims = {}
-    log.debug("Parsing shows for work {0}".format(work))
-    work_parsed = event["parse"](work)
-    for show in shows:
-        show_parsed = event["parse"](show)
-        show_sim = work_parsed.similarity(show_parsed)
-        show_id = shows[show]
-        sims.update({show_sim: [show, show_id]})
-    max_sim = max(sims.keys())
-    most_similar = sims[max_sim]
-    log.debug(most_similar)
-    show_name = most_similar[0]
-    show_id = most_similar[1]
-    log.info("Found {0} with similarity {1} and id {2}".format(show_name, max_sim, show_id))
+    load_catalog()
+    lookup_start = time.time()
+    trigram_match = title_trigrams.lookup(work, limit=vector_candidates)
+    if trigram_match["source"] in ("exact", "near_exact"):
+        most_similar = trigram_match["matches"][:1]
+    else:
+        #Only score the titles that share some spelling with the work, or every title if none do
+        candidates = [label for label, score in trigram_match["matches"]] or None
+        most_similar = title_index.top_k(parser.vector(work), 1, candidates=candidates)
+    log.debug("Title match source was {0} with {1} candidates".format(
+        trigram_match["source"], trigram_match["candidates"]))
+    metrics.record("netflix_lookup", (time.time()-lookup_start)*1000, percentiles=True)
+    show_name = None
+    if most_similar:
+        show_name, max_sim = most_similar[0]
+        #A title removed by a catalog reload can still be in the trigram index for a moment
+        show_id = shows.get(show_name)
+        if show_id is None:
+            show_name = None
+        else:
+            log.info("Found {0} with similarity {1} and id {2}".format(show_name, max_sim, show_id))
     if not show_name:
         return {
             "type":  "error",
@@ -1,8 +1,14 @@
 #Internal imports
 from core.plugin_handler import subscribe
+import core
+import core.repository as repository
+import core.write_behind as write_behind
+import core.cache as cache
+import core.metrics as metrics
 import tools
 #External imports
 import newspaper
+from concurrent.futures import ThreadPoolExecutor, wait
 #Builtin imports
 import logging
 import threading
@@ -10,6 +16,188 @@ import time
 
 log = logging.getLogger()
 
+#Digests are served from the cache and refreshed in the background once they're this many seconds old
+news_ttl = 43200
+
+#Number of articles summarized for each site
+articles_per_site = 4
+
+news_cache = cache.get_cache("news", news_ttl, max_size=500)
+
+site_flights = cache.SingleFlight()
+
+#Shared pool for downloading and summarizing articles, started when it's first needed
+article_pool = None
+
+article_timeout = 30
+
+pool_lock = threading.Lock()
+
+#Bytes downloaded by the last fetch of each site, used to keep prefetching within its budget
+fetch_bytes = {}
+
+#Recent requests per site. The counts are halved after every prefetch run, so they follow recent demand
+site_requests = {}
+
+requests_lock = threading.Lock()
+
+prefetch_lock = threading.Lock()
+
+#Prefetching settings, overridden from the configuration
+prefetch_interval = core.configuration_data.get("news_prefetch_interval", 3600)
+prefetch_sites = core.configuration_data.get("news_prefetch_sites", 10)
+prefetch_concurrency = core.configuration_data.get("news_prefetch_concurrency", 2)
+prefetch_budget = core.configuration_data.get("news_prefetch_budget", 20000000)
+
+def get_article_pool():
+    '''Get the shared article pool, sized from the configuration the first time'''
+    global article_pool
+    global article_timeout
+    if article_pool is None:
+        with pool_lock:
+            if article_pool is None:
+                workers = core.configuration_data.get("news_workers", 8)
+                article_timeout = core.configuration_data.get("news_article_timeout", 30)
+                log.info("Starting news article pool with {0} workers".format(workers))
+                article_pool = ThreadPoolExecutor(max_workers=workers)
+    return article_pool
+
+def build_article_string(article_url):
+    '''Build a formatted string with the article title, summary, and url. Returns the string and bytes downloaded'''
+    log.debug("Building article object for article {0}".format(article_url))
+    article = newspaper.Article(article_url)
+    log.debug("Downloading article {0}".format(article_url))
+    article.download()
+    log.debug("Finished downloading article {0}, parsing".format(article_url))
+    downloaded = len(article.html or "")
+    try:
+        article.parse()
+        log.debug("Finished parsing {0}, running nlp".format(article_url))
+        article.nlp()
+        return "{0} ({1})\n{2}\n".format(
+            str(article.title).encode('ascii', 'ignore').decode('ascii'), article_url, str(article.summary)), downloaded
+    except newspaper.article.ArticleException:
+        log.info("Article exception with url {0}".format(article_url))
+        return None, downloaded
+
+def fetch_digest(site, db):
+    '''Build the digest for a site, store it in the cache and the news table, and return it'''
+    start_time = time.time()
+    log.info("Parsing news site {0}".format(site))
+    site_object = newspaper.build(site, memoize_articles=False)
+    log.debug("Finished building newspaper object")
+    top_articles = site_object.articles[0:articles_per_site]
+    pool = get_article_pool()
+    article_futures = [pool.submit(build_article_string, article.url) for article in top_articles]
+    wait(article_futures, timeout=article_timeout)
+    #Keep the site's order, leaving out articles that failed or didn't finish in time
+    output_strs = []
+    downloaded = len(site_object.html or "")
+    for article_future in article_futures:
+        if article_future.done() and not article_future.exception():
+            article_str, article_bytes = article_future.result()
+            downloaded += article_bytes
+            if article_str:
+                output_strs.append(article_str)
+        else:
+            article_future.cancel()
+    output_str = '\n'.join(output_strs)
+    fetched_at = time.time()
+    fetch_bytes[site] = downloaded
+    metrics.increment("news_bytes", downloaded)
+    if not output_str:
+        #Don't let a failed fetch stand in for a digest. The next request tries again
+        metrics.increment("news_empty")
+        log.warning("No articles could be summarized for news site {0}, not caching the digest".format(site))
+        return output_str
+    news_cache.set(site, output_str, stored_at=fetched_at)
+    write_behind.upsert(db, "news", dict(site=site, time=fetched_at, news_str=output_str), ['site'])
+    metrics.record("news_fetch", (fetched_at-start_time)*1000, percentiles=True)
+    log.info("Cached news digest for site {0}".format(site))
+    return output_str
+
+def get_digest(site, db):
+    '''
+    Get the digest for a site. Cached digests are returned straight away, and refreshed in the background when
+    they're stale. Concurrent requests for a site share one fetch
+    '''
+    digest, fresh = news_cache.lookup(site)
+    if digest is None:
+        #After a restart the cache is empty, but the news table still has the last digest
+        site_row = repository.news_by_site(db, site)
+        if site_row and site_row["news_str"]:
+            news_cache.set(site, site_row["news_str"], stored_at=site_row["time"])
+            digest, fresh = site_row["news_str"], time.time() < site_row["time"]+news_ttl
+    if digest is None:
+        log.info("No cached news for site {0}, fetching it".format(site))
+        return site_flights.do(site, fetch_digest, site, db)
+    if not fresh:
+        log.info("News for site {0} is stale, refreshing it in the background".format(site))
+        site_flights.do_async(site, fetch_digest, site, db)
+    return digest
+
+def rank_sites(db, count):
+    '''Rank news sites by the number of users who read them plus their recent requests'''
+    scores = {}
+    for site_row in repository.news_site_counts(db, count):
+        scores[site_row["news_site"]] = site_row["user_count"]
+    with requests_lock:
+        for site, requests in site_requests.items():
+            scores[site] = scores.get(site, 0)+requests
+        for site in list(site_requests.keys()):
+            site_requests[site] /= 2.0
+            if site_requests[site] < 0.5:
+                del site_requests[site]
+    return sorted(scores, key=scores.get, reverse=True)[:count]
+
+def digest_expiry(site, db):
+    '''Get the time a site's digest goes stale, or 0 if it has never been fetched'''
+    expires = news_cache.expires_at(site)
+    if expires is None:
+        site_row = repository.news_by_site(db, site)
+        expires = site_row["time"]+news_ttl if site_row and site_row["news_str"] else 0
+    return expires
+
+def prefetch(db):
+    '''Refresh the most popular sites whose digests would go stale before the next run'''
+    if not prefetch_lock.acquire(False):
+        log.info("News prefetch is still running, skipping this run")
+        return
+    try:
+        start_time = time.time()
+        refresh_before = start_time+prefetch_interval
+        due_sites = [site for site in rank_sites(db, prefetch_sites) if digest_expiry(site, db) < refresh_before]
+        log.info("Prefetching news for sites {0}".format(due_sites))
+        spent = [0]
+        spent_lock = threading.Lock()
+        def prefetch_site(site):
+            with spent_lock:
+                if spent[0] >= prefetch_budget:
+                    metrics.increment("news_prefetch_skipped")
+                    return
+            try:
+                site_flights.do(site, fetch_digest, site, db)
+                metrics.increment("news_prefetched")
+            except Exception as fetch_error:
+                log.error("Error {0} while prefetching news for site {1}".format(fetch_error, site))
+            with spent_lock:
+                spent[0] += fetch_bytes.get(site, 0)
+        with ThreadPoolExecutor(max_workers=prefetch_concurrency) as prefetch_pool:
+            list(prefetch_pool.map(prefetch_site, due_sites))
+        metrics.record("news_prefetch", (time.time()-start_time)*1000)
+        log.info("Finished prefetching news, downloaded {0} bytes".format(spent[0]))
+    finally:
+        prefetch_lock.release()
+
+def start_prefetch():
+    '''Run the prefetch off the scheduler thread'''
+    prefetch_thread = threading.Thread(target=prefetch, args=(core.db,))
+    prefetch_thread.daemon = True
+    prefetch_thread.start()
+    return "Started news prefetch"
+
+core.schedule_function(start_prefetch, prefetch_interval, "news_prefetch", delay=60)
+
 def is_news(event):
     '''Determine whether to read the news'''
     event_words = [token.orth_.lower() for token in event["doc"]]
@@ -21,51 +209,13 @@ def news_reader(event):
     response = {"type": "success", "text": None, "data": {}}
     db = event['db']
     event_user = event['username']
-    user_table = db['users'].find_one(username=event_user)
+    user_table = repository.user_by_username(db, event_user)
     user_news_site = user_table["news_site"]
-    news_table = db["news"]
-    cached_sites = [list(site.values())[0] for site in db.query("SELECT site from `news`")]
-    log.debug("Cached sites are {0}".format(cached_sites))
-    if user_news_site in cached_sites:
-        site_row = news_table.find_one(site=user_news_site)
-        site_time = site_row["time"]
-        if time.time()<site_time+43200:
-            log.info("Using cached news for site {0}".format(user_news_site))
-            news_str = site_row["news_str"]
-            response["text"] = news_str
-    log.info("Parsing news site {0} for user {1}".format(user_news_site, event_user))
-    site_object = newspaper.build(user_news_site, memoize_articles=False)
-    log.debug("Finished building newspaper object")
-    top_articles = site_object.articles[0:4]
-    log.debug("Top articles are {0}".format(list(top_articles)))
-    output_strs = []
-    #Use multithreading to build the objects for the articles
-    def build_article_object(article_url):
-        '''Build a formatted string with the article title, summary, and url'''
-        log.debug("Building article object for article {0}".format(article_url))
-        article = newspaper.Article(article_url)
-        log.debug("Downloading article {0}".format(article_url))
-        article.download()
-        log.debug("Finished downloading article {0}, parsing".format(article_url))
-        try:
-            article.parse()
-            log.debug("Finished debugging {0}, running nlp".format(article_url))
-            article.nlp()
-            article_str = "{0} ({1})\n{2}\n".format(
-                str(article.title).encode('ascii', 'ignore'), article_url, str(article.summary))
-            output_strs.append(str(article_str))
-        except newspaper.article.ArticleException:
-            log.info(":{0}:Article exception with url {1}".format(event["session"]["id"], article_url))
-    article_threads = []
-    for article in top_articles:
-        article_thread = threading.Thread(target=build_article_object, args=(article.url, ))
-        article_threads.append(article_thread)
-    [thread.start() for thread in article_threads]
-    log.debug("Started news parsing threads, waiting for parsing to finish")
-    [thread.join() for thread in article_threads]
-    log.debug("Compiling article output {0} into string".format(output_strs))
-    output_str = '\n'.join(output_strs)
-    log.debug("Returning output string {0}".format(output_str))
-    db["news"].upsert(dict(site=user_news_site,time=time.time(),news_str=output_str), ['site'])
-    response["text"] = output_str
-    return response
\ No newline at end of file
+    with requests_lock:
+        site_requests[user_news_site] = site_requests.get(user_news_site, 0)+1
+    log.info("Getting news from site {0} for user {1}".format(user_news_site, event_user))
+    response["text"] = get_digest(user_news_site, db)
+    if not response["text"]:
+        response["type"] = "error"
+        response["text"] = "Sorry, I couldn't get the news from {0} right now".format(user_news_site)
+    return response
@@ -5,10 +5,13 @@ import time
 # Internal imports
 import core
 from core.plugin_handler import subscribe
+import core.timeparse as timeparse
+import core.metrics as metrics
 import tools
 import datetime
 import traceback
 import sys
+import re
 
 #External imports
 from dateparser import parse
@@ -16,6 +19,20 @@ from pytz import timezone
 
 log = logging.getLogger()
 
+#Phrases that make a reminder recurring, and the recurrence rule they set
+recurrence_phrases = re.compile(r"\b(?:every\s+(hour|day|week)|(hourly|daily|weekly))\b", re.IGNORECASE)
+
+recurrence_rules = {"hour": "hourly", "day": "daily", "week": "weekly"}
+
+#pytz timezones by name. Building one reads the zone file, so each is only built once
+timezones = {}
+
+def get_timezone(timezone_name):
+    '''Get a cached pytz timezone'''
+    if timezone_name not in timezones:
+        timezones[timezone_name] = timezone(timezone_name)
+    return timezones[timezone_name]
+
 def is_reminder(event):
     '''Check to see whether a reminder should be set'''
     event_command = event["command"]
@@ -67,7 +84,13 @@ def main(event):
             if time_message:
                 break
     if not time_message:
-        time_message == "Reminder: {0}".format(event_command)
+        time_message = "Reminder: {0}".format(event_command)
+    recurrence = None
+    recurrence_match = recurrence_phrases.search(event_command)
+    if recurrence_match:
+        every_unit, rule_word = recurrence_match.groups()
+        recurrence = recurrence_rules[every_unit.lower()] if every_unit else rule_word.lower()
+        log.debug("Reminder recurs {0}".format(recurrence))
     if not event_time:
         if times:
             event_time = times[0]
@@ -82,7 +105,7 @@ def main(event):
         response["text"] = "Error: wasn't able to parse a timezone for the user"
         response["type"] = "error"
         return response
-    tz = timezone(user_timezone)
+    tz = get_timezone(user_timezone)
     datetime_tz = datetime.datetime.now(tz)
     tzname = datetime_tz.tzinfo._tzname
     time_word = "in"
@@ -90,44 +113,73 @@ def main(event):
         if word.tag_ == "IN":
             time_word = word.orth_
             log.debug("using time word {0}".format(time_word))
-    try:
-        #If the event time looks like a numerical time (ex: 1:00), and it's in 12 hour format w/o AM or PM, check whether noon or midnight is closer
-        if ":" in event_time and len(event_time)<5:
-            col_split = event_time.split(":")
-            col_split_pre = col_split[0]
-            #If it's a number
-            log.debug("Checking for 12 hour time")
-            if col_split_pre.isdigit():
-                hour_num = int(col_split_pre)
-                log.debug("Checking hour {0}".format(hour_num))
-                if hour_num < 12:
-                    event_time+=" PM"
-        parse_time_str = "{0} {1} {2}".format(time_word, event_time, tzname)
-        log.debug("Parse time str is {0}".format(parse_time_str))
-        time_in_seconds = (
-            parse(
-                parse_time_str,
-                settings={
-                    "RETURN_AS_TIMEZONE_AWARE": True
-                }
-            )
-            - datetime_tz).total_seconds()
-    except:
-        traceback.print_exc(sys.stdout)
-        response["text"] = "Couldn't parse a time from {0}".format(event_time)
-        response["type"] = "error"
-        return response
+    #Try the common forms first, using the time and date entities spaCy found, then the parsed time phrase
+    time_phrases = times+dates+["{0} {1}".format(time_word, event_time)]
+    if dates and times:
+        time_phrases.insert(0, "{0} {1}".format(dates[0], times[0]))
+    #The fast path only knows today, tonight, and tomorrow. Any other date, like "Friday", goes to dateparser so
+    #it isn't dropped in favour of a bare time
+    other_dates = [date for date in dates if timeparse.normalize(date) not in timeparse.day_words
+                   and not recurrence_phrases.search(date)]
+    if other_dates:
+        log.debug("Dates {0} need dateparser".format(other_dates))
+        time_phrases = []
+    time_in_seconds = None
+    for time_phrase in time_phrases:
+        time_in_seconds = timeparse.parse(time_phrase, datetime_tz, tz)
+        if time_in_seconds is not None:
+            log.debug("Parsed time phrase {0} on the fast path".format(time_phrase))
+            break
+    #The average of this series is the fast path hit rate
+    metrics.record("reminder_fast_path", 1 if time_in_seconds is not None else 0)
+    if time_in_seconds is None and recurrence and not times and not other_dates:
+        #Recurring reminders without a time start one interval from now
+        time_in_seconds = core.recurrence_intervals[recurrence]
+    if time_in_seconds is None:
+        try:
+            #If the event time looks like a numerical time (ex: 1:00), and it's in 12 hour format w/o AM or PM, check whether noon or midnight is closer
+            if ":" in event_time and len(event_time)<5:
+                col_split = event_time.split(":")
+                col_split_pre = col_split[0]
+                #If it's a number
+                log.debug("Checking for 12 hour time")
+                if col_split_pre.isdigit():
+                    hour_num = int(col_split_pre)
+                    log.debug("Checking hour {0}".format(hour_num))
+                    if hour_num < 12:
+                        event_time+=" PM"
+            parse_time_str = "{0} {1} {2}".format(time_word, event_time, tzname)
+            log.debug("Parse time str is {0}".format(parse_time_str))
+            time_in_seconds = (
+                parse(
+                    parse_time_str,
+                    settings={
+                        "RETURN_AS_TIMEZONE_AWARE": True
+                    }
+                )
+                - datetime_tz).total_seconds()
+        except:
+            traceback.print_exc(sys.stdout)
+            response["text"] = "Couldn't parse a time from {0}".format(event_time)
+            response["type"] = "error"
+            return response
     log.info("Alert text is {0}".format(time_message))
     #Set the reminder using the events framework
     alert_time = time.time()+time_in_seconds
     log.info("Alert time is {0}, time is {1}, time_in seconds is {2}".format(alert_time, time.time(), time_in_seconds))
     event_id = tools.get_event_uid("notification")
-    core.events.append({
+    reminder_event = {
         "username": event["session"]["username"],
         "time": time.time()+time_in_seconds,
         "value": time_message,
         "type": "notification",
         "uid": event_id
-    })
+    }
+    if recurrence:
+        #Only the rule is stored. The scheduler moves the event to its next occurrence each time it fires
+        reminder_event["recurrence"] = recurrence
+    core.add_event(reminder_event, event["db"])
     response["text"] = "Got it. I'll send you the following reminder: {0} {1} {2}".format(time_message, time_word,  event_time)
+    if recurrence:
+        response["text"] += ", repeating {0}".format(recurrence)
     return response
@@ -1,5 +1,9 @@
 # Internal imports
 from core.plugin_handler import subscribe
+import core
+import core.keys as keys
+import core.metrics as metrics
+import core.cache as cache
 import tools
 
 # External imports
@@ -12,24 +16,87 @@ import requests
 
 # Builtin imports
 import logging
+import threading
+import time
+import json
+import os
+import atexit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 log = logging.getLogger()
 
-def search_google(query):
-    '''Search google and determine if wikipedia is in it'''
+#Seconds to wait for the backends before answering with the best result so far
+search_deadline = core.configuration_data.get("search_deadline", 8)
+
+search_workers = core.configuration_data.get("search_workers", 12)
+
+#Search backends in order of priority. When a backend answers, the answer is used as soon as every backend
+#above it has come up empty
+backends = ["wolfram", "wikipedia", "article"]
+
+#Shared pool for the backend requests, started when it's first needed
+search_pool = None
+
+pool_lock = threading.Lock()
+
+#Seconds an answer is cached for, by the backend that gave it
+cache_ttls = {"wolfram": 604800, "wikipedia": 86400, "article": 21600}
+cache_ttls.update(core.configuration_data.get("search_cache_ttls", {}))
+
+answer_cache = cache.get_cache("search", max(cache_ttls.values()),
+                               max_size=core.configuration_data.get("search_cache_size", 5000))
+
+#If set, cached answers are saved to this file so they survive restarts
+cache_file = core.configuration_data.get("search_cache_file")
+
+cache_save_interval = core.configuration_data.get("search_cache_save_interval", 300)
+
+def normalize_query(doc):
+    '''Build the cache key for a query from its parsed doc: lowercased lemmas without punctuation'''
+    words = []
+    for token in doc:
+        if token.is_punct or token.is_space:
+            continue
+        #spaCy lemmatizes every personal pronoun to -PRON-, which would merge different questions
+        lemma = token.lemma_ if token.lemma_ != "-PRON-" else token.lower_
+        words.append(lemma.lower())
+    return " ".join(words)
+
+def load_cache():
+    '''Load the saved answers'''
+    try:
+        with open(cache_file) as saved_cache:
+            answer_cache.load(json.load(saved_cache))
+        log.info("Loaded {0} cached search answers from {1}".format(answer_cache.stats()["size"], cache_file))
+    except (IOError, ValueError) as load_error:
+        log.warning("Couldn't load cached search answers from {0}: {1}".format(cache_file, load_error))
+
+def save_cache():
+    '''Save the cached answers, writing a temporary file first so a crash can't leave a partial one'''
+    temp_file = "{0}.tmp".format(cache_file)
+    with open(temp_file, 'w') as saved_cache:
+        json.dump(answer_cache.dump(), saved_cache)
+    os.rename(temp_file, cache_file)
+    return "Saved cached search answers"
+
+if cache_file:
+    if os.path.isfile(cache_file):
+        load_cache()
+    core.schedule_function(save_cache, cache_save_interval, "search_cache_save")
+    atexit.register(save_cache)
+
+def search_wikipedia(query):
+    '''Summarize the top wikipedia page for the query'''
+    wikipedia_search = wikipedia.search(query)
+    if not wikipedia_search:
+        return False
+    page = wikipedia.page(wikipedia_search[0])
+    return page.summary + " ({0})".format(page.url)
+
+def search_article(query):
+    '''Summarize the first google result for the query'''
     search_object = google.search(query)
-    #Determine if a wikipedia url is in the first 5 searches
-    urls = []
-    for i in range(0, 4):
-        url = search_object.__next__()
-        urls.append(url)
-        if "wikipedia.org/wiki" in url:
-            wikipedia_search = wikipedia.search(query)[0]
-            url = wikipedia.page(wikipedia_search).url
-            response = wikipedia.summary(wikipedia_search) + " ({0})".format(url)
-            return response
-    #If there were no wikipedia pages
-    first_url = urls[0]
+    first_url = next(search_object)
     try:
         article = Article(first_url)
         article.download()
@@ -42,28 +109,23 @@ def search_google(query):
         )
 
     except Exception as article_exception:
-        try:
-            log.debug("Got error {0}, {1} while using newspaper, switching to bs4".format(
-            article_exception.message,article_exception.args
-            ))
-            html = requests.get(first_url).text
-            #Parse the html using bs4
-            soup = BeautifulSoup(html, "html.parser")
-            [s.extract() for s in soup(['style', 'script', '[document]', 'head', 'title'])]
-            text = soup.getText()
-         # break into lines and remove leading and trailing space on each
-            lines = (line.strip() for line in text.splitlines())
-            # break multi-headlines into a line each
-            chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-            # drop blank lines
-            soup_text = '\n'.join(chunk for chunk in chunks if " " in chunk)
-            response = format(soup_text) + " ({0})".format(first_url)
-            return response
-        except Exception as search_exception:
-            log.info("Error {0},{1} occurred while searching query {2}".format(
-                search_exception.message, search_exception.args, query
-            ))
-            return "Error encountered on query {0}".format(query)
+        log.debug("Got error {0}, {1} while using newspaper, switching to bs4".format(
+        article_exception, article_exception.args
+        ))
+        html = requests.get(first_url, timeout=search_deadline).text
+        #Parse the html using bs4
+        soup = BeautifulSoup(html, "html.parser")
+        [s.extract() for s in soup(['style', 'script', '[document]', 'head', 'title'])]
+        text = soup.getText()
+     # break into lines and remove leading and trailing space on each
+        lines = (line.strip() for line in text.splitlines())
+        # break multi-headlines into a line each
+        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+        # drop blank lines
+        soup_text = '\n'.join(chunk for chunk in chunks if " " in chunk)
+        response = format(soup_text) + " ({0})".format(first_url)
+        return response
+
 def search_wolfram(query, api_key):
     '''Search wolframalpha'''
     client = wolframalpha.Client(api_key)
@@ -107,6 +169,79 @@ def is_search(event):
     return False
 
 
+def get_search_pool():
+    '''Get the shared search pool, starting it the first time'''
+    global search_pool
+    if search_pool is None:
+        with pool_lock:
+            if search_pool is None:
+                search_pool = ThreadPoolExecutor(max_workers=search_workers)
+    return search_pool
+
+def timed_backend(backend, function, *args):
+    '''Run a backend and record its latency'''
+    start_time = time.time()
+    try:
+        return function(*args)
+    finally:
+        metrics.record("search_latency:{0}".format(backend), (time.time()-start_time)*1000, percentiles=True)
+
+def fan_out(query, db):
+    '''
+    Query every backend at once and return the highest priority answer available, waiting at most
+    search_deadline seconds. Returns the answer and the backend that gave it, or (False, None).
+    Backends that are still running at the deadline can't be stopped. They keep their worker thread until their
+    request finishes, so each backend call should have its own timeout
+    '''
+    pool = get_search_pool()
+    futures = {}
+    try:
+        wolfram_key = tools.load_key("wolfram", db)
+        futures["wolfram"] = pool.submit(timed_backend, "wolfram", search_wolfram, query, wolfram_key)
+    except keys.KeysExhausted:
+        log.warning("No wolfram keys left, searching without wolfram")
+    futures["wikipedia"] = pool.submit(timed_backend, "wikipedia", search_wikipedia, query)
+    futures["article"] = pool.submit(timed_backend, "article", search_article, query)
+    deadline = time.time()+search_deadline
+    pending = set(futures.values())
+    answer, winner = False, None
+    while True:
+        #Go down the priority list until reaching a backend that's still running
+        for backend in [b for b in backends if b in futures]:
+            backend_future = futures[backend]
+            if not backend_future.done():
+                break
+            if backend_future.exception():
+                log.info("Search backend {0} failed with {1}".format(backend, backend_future.exception()))
+            elif backend_future.result():
+                answer, winner = backend_future.result(), backend
+                break
+        else:
+            #Every backend finished without an answer
+            break
+        if winner:
+            break
+        remaining = deadline-time.time()
+        if remaining <= 0:
+            #Out of time, so take the best answer that's finished
+            metrics.increment("search_timeout")
+            for backend in [b for b in backends if b in futures]:
+                backend_future = futures[backend]
+                if backend_future.done() and not backend_future.exception() and backend_future.result():
+                    answer, winner = backend_future.result(), backend
+                    break
+            break
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+    #Calls still queued for a worker are dropped. Calls that are already running can't be interrupted, so they
+    #finish in the background, holding their worker, and their results are ignored
+    abandoned = len([f for f in futures.values() if not f.cancel() and not f.done()])
+    if abandoned:
+        metrics.increment("search_abandoned", abandoned)
+    metrics.increment("searches")
+    if winner:
+        metrics.increment("search_win:{0}".format(winner))
+    return answer, winner
+
 @subscribe({"name": "search", "check": is_search})
 def main(data):
     '''Start the search'''
@@ -114,13 +249,18 @@ def main(data):
     query = data["command"]
     log.info("In main search function with query {0}".format(query))
     db = data["db"]
-    answer = False
-    wolfram_key = tools.load_key("wolfram", db)
-    wolfram_response = search_wolfram(query, wolfram_key)
-    # If it found an answer answer will be set to that, if not it'll still be false
-    answer = wolfram_response
+    query_key = normalize_query(data["doc"])
+    cached_answer = answer_cache.get(query_key)
+    if cached_answer:
+        log.info("Answering query {0} from the cache".format(query))
+        response["text"] = cached_answer["answer"]
+        return response
+    answer, winner = fan_out(query, db)
     if answer:
+        log.info("Answering query {0} with the {1} result".format(query, winner))
+        answer_cache.set(query_key, {"answer": answer, "source": winner}, ttl=cache_ttls[winner])
         response["text"] = answer
     else:
-        response["text"]=search_google(query)
+        response["type"] = "error"
+        response["text"] = "Couldn't find an answer to {0}".format(query)
     return response
@@ -1,16 +1,58 @@
 #Internal imports
 from core.plugin_handler import subscribe
+import core
+import core.trigrams as trigrams
+import core.cache as cache
 import tools
 
 #External imports
 import spotipy
+import requests
+from requests.adapters import HTTPAdapter
 
 #Builtin imports
 import logging
 
-sp = spotipy.Spotify()
 log = logging.getLogger()
 
+#One pooled session, so searches reuse kept-alive connections to the Spotify API
+spotify_session = requests.Session()
+spotify_session.mount("https://", HTTPAdapter(
+    pool_connections=1, pool_maxsize=core.configuration_data.get("spotify_pool_size", 10)))
+
+sp = spotipy.Spotify(requests_session=spotify_session,
+                     requests_timeout=core.configuration_data.get("spotify_timeout", 5))
+
+spotify_cache_ttl = core.configuration_data.get("spotify_cache_ttl", 86400)
+
+spotify_cache_size = core.configuration_data.get("spotify_cache_size", 2000)
+
+#Ranked search results by normalized query
+search_cache = cache.get_cache("spotify", spotify_cache_ttl, max_size=spotify_cache_size)
+
+search_flights = cache.SingleFlight()
+
+#Tracks found by earlier searches, by name, so requests for them can be answered without searching again. They
+#expire and are evicted like the search results
+track_cache = cache.get_cache("spotify_tracks", spotify_cache_ttl, max_size=spotify_cache_size)
+
+#Trigram index of the names in track_cache
+track_index = trigrams.TrigramIndex("spotify")
+
+def search_tracks(query):
+    '''Search spotify for tracks, rank them by popularity, and cache the ranking'''
+    song = sp.search(q='track:' + query, type='track')
+    ranked_tracks = [{
+        "name": song_item["name"],
+        "popularity": song_item["popularity"],
+        "url": song_item["external_urls"]["spotify"],
+        "artist": song_item["artists"][0]["name"]
+    } for song_item in song["tracks"]["items"]]
+    #Sorting is stable, so tracks with the same popularity keep spotify's order
+    ranked_tracks.sort(key=lambda track: -track["popularity"])
+    search_cache.set(query, ranked_tracks)
+    return ranked_tracks
+
 def is_spotify(event):
     event_doc = event["doc"]
     return "spotify" in [word.orth_.lower() for word in event_doc]
@@ -30,21 +72,34 @@ def main(event):
             "data": {}
         }
     log.debug("In spotify module, found work {0}".format(work))
-    song = sp.search(q='track:' + work, type='track')
-    #Get the most popular of the found results
-    song_items = song["tracks"]["items"]
-    pops = {}
-    for song_array in song_items:
-        song_popularity = song_array["popularity"]
-        pops.update({song_popularity: song_array})
-    song_item = pops[max(pops.keys())]
-    song_data = {
-        "name": song_item["name"],
-        "popularity": song_item["popularity"],
-        "url": song_item["external_urls"]["spotify"],
-        "artist": song_item["artists"][0]["name"]
-    }
+    track_match = track_index.lookup(work, limit=1)
+    if track_match["source"] in ("exact", "near_exact"):
+        track_name = track_match["matches"][0][0]
+        song_data = track_cache.get(track_name)
+        if song_data is not None:
+            log.debug("Found known track {0}".format(song_data))
+            song_str = "Directing you to {0} by {1}".format(song_data["name"], song_data["artist"])
+            return {"type": "success", "text": song_str, "data": {"url": song_data["url"]}}
+        #The track expired or was evicted, so search for it again
+        track_index.remove(track_name)
+    query = trigrams.normalize(work)
+    ranked_tracks = search_cache.get(query)
+    if ranked_tracks is None:
+        #Identical searches that arrive together share one request
+        ranked_tracks = search_flights.do(query, search_tracks, query)
+    if not ranked_tracks:
+        return {
+            "type": "error",
+            "text": "Couldn't find {0} on spotify".format(work),
+            "data": {}
+        }
+    song_data = ranked_tracks[0]
     log.debug("Found song {0}".format(song_data))
+    track_cache.set(song_data["name"], song_data)
+    track_index.add(song_data["name"])
+    if len(track_index) > track_cache.max_size:
+        #Drop the names of tracks the cache has evicted
+        track_index.update(track_cache.keys())
     #Get most popular song
     song_str = "Directing you to {0} by {1}".format(song_data["name"], song_data["artist"])
     return {"type": "success", "text": song_str, "data": {"url": song_data["url"]}}
\ No newline at end of file
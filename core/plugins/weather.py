@@ -1,17 +1,83 @@
 # Internal imports
 from core.plugin_handler import subscribe
+import core
+import core.repository as repository
+import core.cache as cache
+import core.trigrams as trigrams
+import core.keys as keys
+import core.metrics as metrics
 import tools
 
 #Builtin imports
 import logging
 import traceback
 import sys
+import threading
+import time
 
 # External imports
 import pyowm
 
 log = logging.getLogger()
 
+#Observations by normalized location, shared by every user in the location
+weather_cache = cache.get_cache("weather", core.configuration_data.get("weather_cache_ttl", 600),
+                                max_size=core.configuration_data.get("weather_cache_size", 5000))
+
+weather_flights = cache.SingleFlight()
+
+#OWM clients by api key, so each key's client is only created once
+owm_clients = {}
+
+clients_lock = threading.Lock()
+
+#OWM city ids by normalized location, learned from fetches, so refreshes can use the group endpoint
+location_ids = {}
+
+#Refreshing settings, overridden from the configuration
+refresh_interval = core.configuration_data.get("weather_refresh_interval", 120)
+refresh_locations = core.configuration_data.get("weather_refresh_locations", 100)
+#Locations are refreshed when their observation goes stale within this many seconds
+refresh_margin = core.configuration_data.get("weather_refresh_margin", 150)
+#Maximum OWM requests in one refresh run
+refresh_max_calls = core.configuration_data.get("weather_refresh_max_calls", 20)
+
+#The OWM group endpoint takes at most 20 city ids
+group_size = 20
+
+refresh_lock = threading.Lock()
+
+def get_client(pyowm_key):
+    '''Get the OWM client for a key'''
+    with clients_lock:
+        if pyowm_key not in owm_clients:
+            owm_clients[pyowm_key] = pyowm.OWM(pyowm_key)
+        return owm_clients[pyowm_key]
+
+def location_string(user_table):
+    '''Build the place string OWM is queried with from the user's location'''
+    if user_table["state"]:
+        return "{0}, {1}".format(user_table["city"], user_table["state"])
+    return "{0}, {1}".format(user_table["city"], user_table["country"])
+
+def fetch_observation(location, db):
+    '''Fetch the weather for a location and cache it'''
+    owm = get_client(tools.load_key("pyowm", db))
+    observation = owm.weather_at_place(location)
+    location_data = {"weather": observation.get_weather(), "location_id": observation.get_location().get_ID()}
+    location_key = trigrams.normalize(location)
+    location_ids[location_key] = location_data["location_id"]
+    weather_cache.set(location_key, location_data)
+    return location_data
+
+def get_weather(location, db):
+    '''Get the cached weather for a location, fetching it once for everyone who asks while it's missing'''
+    location_key = trigrams.normalize(location)
+    location_data = weather_cache.get(location_key)
+    if location_data is None:
+        location_data = weather_flights.do(location_key, fetch_observation, location, db)
+    return location_data["weather"]
+
 def is_weather(event):
     '''Determine whether to read the news'''
     event_words = [token.orth_.lower() for token in event["doc"]]
@@ -102,6 +168,84 @@ def ask_country(response_value, event):
         response["text"] = "City {0} failed string validation".format(response_value)
     return response
 
+def refresh(db):
+    '''
+    Keep the weather of the locations with the most users warm, refreshing the ones that are about to go stale.
+    Locations with a known city id are refreshed 20 at a time through the group endpoint
+    '''
+    if not refresh_lock.acquire(False):
+        log.info("Weather refresh is still running, skipping this run")
+        return
+    try:
+        start_time = time.time()
+        due_locations = {}
+        for location_row in repository.top_locations(db, refresh_locations):
+            location = location_string(location_row)
+            location_key = trigrams.normalize(location)
+            expires = weather_cache.expires_at(location_key)
+            if expires is not None:
+                metrics.record("weather_location_age", start_time-(expires-weather_cache.ttl))
+            if expires is None or expires < start_time+refresh_margin:
+                due_locations[location_key] = location
+        metrics.record("weather_refresh_due", len(due_locations))
+        grouped = {}
+        single = []
+        for location_key, location in due_locations.items():
+            if location_key in location_ids:
+                grouped.setdefault(location_ids[location_key], []).append(location_key)
+            else:
+                single.append(location)
+        location_id_list = list(grouped.keys())
+        calls = 0
+        refreshed = 0
+        try:
+            for i in range(0, len(location_id_list), group_size):
+                if calls >= refresh_max_calls:
+                    break
+                id_group = location_id_list[i:i+group_size]
+                owm = get_client(tools.load_key("pyowm", db))
+                calls += 1
+                try:
+                    observations = owm.weather_at_ids(id_group)
+                except Exception as fetch_error:
+                    log.error("Error {0} while refreshing weather for city ids {1}".format(fetch_error, id_group))
+                    continue
+                for observation in observations:
+                    location_id = observation.get_location().get_ID()
+                    location_data = {"weather": observation.get_weather(), "location_id": location_id}
+                    for location_key in grouped.get(location_id, []):
+                        weather_cache.set(location_key, location_data)
+                        refreshed += 1
+            for location in single:
+                if calls >= refresh_max_calls:
+                    break
+                calls += 1
+                try:
+                    weather_flights.do(trigrams.normalize(location), fetch_observation, location, db)
+                    refreshed += 1
+                except keys.KeysExhausted:
+                    raise
+                except Exception as fetch_error:
+                    log.error("Error {0} while refreshing weather for {1}".format(fetch_error, location))
+        except keys.KeysExhausted:
+            log.warning("Out of pyowm keys, stopping the weather refresh")
+        metrics.increment("weather_refresh_calls", calls)
+        metrics.increment("weather_refreshed", refreshed)
+        metrics.record("weather_refresh", (time.time()-start_time)*1000)
+        log.info("Refreshed weather for {0} of {1} due locations with {2} requests".format(
+            refreshed, len(due_locations), calls))
+    finally:
+        refresh_lock.release()
+
+def start_refresh():
+    '''Run the refresh off the scheduler thread'''
+    refresh_thread = threading.Thread(target=refresh, args=(core.db,))
+    refresh_thread.daemon = True
+    refresh_thread.start()
+    return "Started weather refresh"
+
+core.schedule_function(start_refresh, refresh_interval, "weather_refresh", delay=30)
+
 @subscribe({"name": "weather", "check": is_weather})
 def weather_main(event):
     '''Get the users weather from the infromation in the users database'''
@@ -109,25 +253,17 @@ def weather_main(event):
     response = {"type": "success", "text": None, "data": {}}
     db = event["db"]
     username = event["username"]
-    user_table = db["users"].find_one(username=username)
+    user_table = repository.user_by_username(db, username)
     if (user_table["city"] and user_table["country"]):
-        if user_table["state"]:
-            fetch_str = "{0}, {1}".format(user_table["city"], user_table["state"])
-        else:
-            fetch_str = "{0}, {1}".format(user_table["city"], user_table["country"])
-        pyowm_key = tools.load_key("pyowm", db)
-        owm = pyowm.OWM(pyowm_key)
-        observation = owm.weather_at_place(fetch_str)
-        w = observation.get_weather()
+        fetch_str = location_string(user_table)
+        w = get_weather(fetch_str, db)
         status = w.get_detailed_status()
         temp_sym = "F"
-        if "temp_unit" in user_table.keys():
-            user_temp_unit = user_table["temp_unit"]
-            temperature = w.get_temperature(user_temp_unit)
-            if user_temp_unit == "celsius":
-                temp_sym = "C"
-        else:
-            temperature = w.get_temperature('fahrenheit')
+        #The conversion is done per user from the shared observation
+        user_temp_unit = user_table.get("temp_unit") or "fahrenheit"
+        temperature = w.get_temperature(user_temp_unit)
+        if user_temp_unit == "celsius":
+            temp_sym = "C"
 
         weather_str = "Weather for {0} is {1}, with a temperature of {2} {3}".format(
             fetch_str, status, temperature["temp"], temp_sym)
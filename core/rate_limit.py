@@ -0,0 +1,124 @@
+#Builtin imports
+import logging
+import threading
+import time
+
+#Internal imports
+import core.metrics as metrics
+
+log = logging.getLogger()
+
+#Requests per second and burst size for each scope. Can be overridden with "rate_limits" in will.conf
+limits = {
+    "global": {"rate": 50, "burst": 100},
+    "user": {"rate": 2, "burst": 10},
+    "session": {"rate": 2, "burst": 10},
+    "ip": {"rate": 5, "burst": 20}
+}
+
+buckets = {}
+
+#Buckets that have been idle this long are full again and can be dropped
+idle_timeout = 600
+
+checks = 0
+
+
+class TokenBucket():
+    '''
+    A token bucket with its own lock, so buckets for different users never contend with each other
+    '''
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, now=None):
+        """
+        Take a token from the bucket if one is available
+
+        :param now:
+        :return boolean:
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+def initialize(configuration_data):
+    """
+    Load rate limits from the configuration
+
+    :param configuration_data:
+    """
+    if "rate_limits" in configuration_data.keys():
+        for scope, scope_limits in configuration_data["rate_limits"].items():
+            if scope not in limits:
+                log.error(":RATE:Ignoring rate limits for unknown scope {0}, the scopes are {1}".format(
+                    scope, list(limits.keys())))
+                continue
+            limits[scope].update(scope_limits)
+    buckets.clear()
+    log.info(":RATE:Loaded rate limits {0}".format(limits))
+
+
+def get_bucket(scope, key):
+    """
+    Get or create the bucket for a scope and key
+
+    :param scope:
+    :param key:
+    :return TokenBucket:
+    """
+    bucket = buckets.get((scope, key))
+    if bucket is None:
+        scope_limits = limits[scope]
+        #setdefault is atomic, so two requests racing to create a bucket get the same one
+        bucket = buckets.setdefault((scope, key), TokenBucket(scope_limits["rate"], scope_limits["burst"]))
+    return bucket
+
+
+def prune(now=None):
+    """
+    Drop buckets that haven't been used recently
+
+    :param now:
+    """
+    if now is None:
+        now = time.time()
+    for bucket_key in [k for k, b in list(buckets.items()) if k[0] != "global" and now - b.last > idle_timeout]:
+        buckets.pop(bucket_key, None)
+
+
+def allow(username=None, session_id=None, client_ip=None):
+    """
+    Check a request against the global, user, session, and client ip buckets. The username must be one the
+    request has authenticated as, otherwise anyone could drain another user's bucket
+
+    :param username: Authenticated username
+    :param session_id:
+    :param client_ip: Address of a client that isn't authenticated
+    :return the scope that rejected the request, or None if it's allowed:
+    """
+    global checks
+    checks += 1
+    now = time.time()
+    if checks % 1000 == 0:
+        prune(now)
+    scopes = [("session", session_id), ("user", username), ("ip", client_ip), ("global", None)]
+    for scope, key in scopes:
+        if scope != "global" and key is None:
+            continue
+        if not get_bucket(scope, key).take(now):
+            metrics.increment("rate_limited")
+            metrics.increment("rate_limited:{0}".format(scope))
+            return scope
+    return None
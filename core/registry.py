@@ -0,0 +1,125 @@
+#Builtin imports
+import logging
+import threading
+
+#Internal imports
+import core.metrics as metrics
+
+log = logging.getLogger()
+
+
+class SessionRegistry(dict):
+    '''
+    The core.sessions dictionary. Adding and removing sessions keeps live counts of online users, sessions
+    per client type, and command rates, so reports can read them without scanning every session
+    '''
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self.lock = threading.Lock()
+        self.user_sessions = {}
+        self.client_sessions = {}
+        self.command_rate = metrics.RateWindows()
+        self.update(*args, **kwargs)
+
+    def _count(self, counts, key, amount):
+        """
+        Change a count, removing it when it hits zero. Must be called with the lock held
+
+        :param counts:
+        :param key:
+        :param amount:
+        """
+        new_count = counts.get(key, 0) + amount
+        if new_count > 0:
+            counts[key] = new_count
+        else:
+            counts.pop(key, None)
+
+    def _added(self, session_data):
+        self._count(self.user_sessions, session_data.get("username"), 1)
+        self._count(self.client_sessions, session_data.get("client"), 1)
+
+    def _removed(self, session_data):
+        self._count(self.user_sessions, session_data.get("username"), -1)
+        self._count(self.client_sessions, session_data.get("client"), -1)
+
+    def __setitem__(self, session_id, session_data):
+        with self.lock:
+            if session_id in self:
+                self._removed(dict.__getitem__(self, session_id))
+            dict.__setitem__(self, session_id, session_data)
+            self._added(session_data)
+
+    def __delitem__(self, session_id):
+        with self.lock:
+            self._removed(dict.__getitem__(self, session_id))
+            dict.__delitem__(self, session_id)
+
+    def update(self, *args, **kwargs):
+        for session_id, session_data in dict(*args, **kwargs).items():
+            self[session_id] = session_data
+
+    def setdefault(self, session_id, session_data=None):
+        if session_id not in self:
+            self[session_id] = session_data
+        return self[session_id]
+
+    def pop(self, session_id, *default):
+        with self.lock:
+            if session_id in self:
+                self._removed(dict.__getitem__(self, session_id))
+            return dict.pop(self, session_id, *default)
+
+    def popitem(self):
+        with self.lock:
+            session_id, session_data = dict.popitem(self)
+            self._removed(session_data)
+            return session_id, session_data
+
+    def clear(self):
+        with self.lock:
+            dict.clear(self)
+            self.user_sessions.clear()
+            self.client_sessions.clear()
+
+    def record_command(self):
+        """
+        Count a processed command towards the command rates
+
+        """
+        self.command_rate.record()
+
+    def users_online(self):
+        """
+        :return the number of distinct users with an active session:
+        """
+        return len(self.user_sessions)
+
+    def online_users(self, page=0, page_size=50):
+        """
+        Get a page of the users that are currently online
+
+        :param page:
+        :param page_size:
+        :return list of usernames:
+        """
+        with self.lock:
+            usernames = sorted(str(username) for username in self.user_sessions)
+        return usernames[page*page_size:(page+1)*page_size]
+
+    def stats(self):
+        """
+        Get the live session statistics
+
+        :return dict of statistics:
+        """
+        with self.lock:
+            clients = dict(self.client_sessions)
+            users_online = len(self.user_sessions)
+            active_sessions = len(self)
+        return {
+            "users_online": users_online,
+            "active_sessions": active_sessions,
+            "clients": clients,
+            "commands_per_minute": self.command_rate.rates()
+        }
@@ -0,0 +1,185 @@
+#Builtin imports
+import logging
+import time
+
+#External imports
+import dataset
+from sqlalchemy import text
+
+#Internal imports
+import core.metrics as metrics
+
+log = logging.getLogger()
+
+#Parameterized statements for the hot queries. They're built once so SQLAlchemy can reuse the compiled statements
+statements = {
+    "user_by_username": text("SELECT * FROM `users` WHERE username = :username LIMIT 1"),
+    "all_keys": text("SELECT * FROM `keys`"),
+    "keys_by_type": text("SELECT * FROM `keys` WHERE type = :type"),
+    "delete_events_before": text("DELETE FROM `events` WHERE time <= :time AND recurrence IS NULL"),
+    "news_by_site": text("SELECT * FROM `news` WHERE site = :site LIMIT 1"),
+    "news_site_counts": text("SELECT news_site, COUNT(*) AS user_count FROM `users` WHERE news_site IS NOT NULL "
+                             "GROUP BY news_site ORDER BY user_count DESC LIMIT :limit"),
+    "top_locations": text("SELECT city, state, country, COUNT(*) AS user_count FROM `users` "
+                          "WHERE city IS NOT NULL AND country IS NOT NULL GROUP BY city, state, country "
+                          "ORDER BY user_count DESC LIMIT :limit"),
+    "active_revocations": text("SELECT token_hash, expires FROM `revoked_tokens` WHERE expires > :time"),
+    "delete_revocations_before": text("DELETE FROM `revoked_tokens` WHERE expires <= :time"),
+    "events_window": text("SELECT * FROM `events` WHERE time > :start AND time <= :end AND id > :after_id "
+                          "ORDER BY id LIMIT :limit")
+}
+
+
+def connect(db_url, configuration_data):
+    """
+    Connect to the database with a connection pool sized from the configuration
+
+    :param db_url:
+    :param configuration_data:
+    :return dataset database:
+    """
+    engine_kwargs = {"pool_recycle": configuration_data.get("db_pool_recycle", 3600)}
+    #SQLite uses its own pools that don't take a size
+    if not db_url.startswith("sqlite"):
+        engine_kwargs.update({
+            "pool_size": configuration_data.get("db_pool_size", 10),
+            "max_overflow": configuration_data.get("db_max_overflow", 20),
+            "pool_timeout": configuration_data.get("db_pool_timeout", 10)
+        })
+    log.info(":DB:Connecting with engine options {0}".format(engine_kwargs))
+    return dataset.connect(db_url, engine_kwargs=engine_kwargs)
+
+
+def query(db, name, **params):
+    """
+    Run a named statement and time it
+
+    :param db:
+    :param name:
+    :param params:
+    :return list of rows as dicts:
+    """
+    start_time = time.time()
+    try:
+        return [dict(row) for row in db.query(statements[name], **params)]
+    finally:
+        metrics.record("query:{0}".format(name), (time.time()-start_time)*1000, percentiles=True)
+
+
+def execute(db, name, **params):
+    """
+    Run a named statement that doesn't return rows and time it
+
+    :param db:
+    :param name:
+    :param params:
+    """
+    start_time = time.time()
+    try:
+        db.executable.execute(statements[name], **params)
+    finally:
+        metrics.record("query:{0}".format(name), (time.time()-start_time)*1000, percentiles=True)
+
+
+def user_by_username(db, username):
+    """
+    :param db:
+    :param username:
+    :return the user's row, or None:
+    """
+    rows = query(db, "user_by_username", username=username)
+    return rows[0] if rows else None
+
+
+def all_keys(db):
+    """
+    :param db:
+    :return every row in the keys table:
+    """
+    return query(db, "all_keys")
+
+
+def keys_by_type(db, key_type):
+    """
+    :param db:
+    :param key_type:
+    :return the rows of the keys of a type:
+    """
+    return query(db, "keys_by_type", type=key_type)
+
+
+def news_by_site(db, site):
+    """
+    :param db:
+    :param site:
+    :return the site's stored news digest row, or None:
+    """
+    rows = query(db, "news_by_site", site=site)
+    return rows[0] if rows else None
+
+
+def news_site_counts(db, limit):
+    """
+    :param db:
+    :param limit:
+    :return rows of news_site and user_count for the news sites set by the most users:
+    """
+    return query(db, "news_site_counts", limit=limit)
+
+
+def top_locations(db, limit):
+    """
+    :param db:
+    :param limit:
+    :return rows of city, state, country, and user_count for the locations with the most users:
+    """
+    return query(db, "top_locations", limit=limit)
+
+
+def stream_events(db, start_time, end_time, chunk_size=500):
+    """
+    Stream the stored events due after start_time and at or before end_time, fetching chunk_size rows at a time
+
+    :param db:
+    :param start_time: Epoch time
+    :param end_time: Epoch time
+    :param chunk_size:
+    :return generator of event rows:
+    """
+    after_id = 0
+    while True:
+        rows = query(db, "events_window", start=start_time, end=end_time, after_id=after_id, limit=chunk_size)
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        after_id = rows[-1]["id"]
+
+
+def delete_events_before(db, before_time):
+    """
+    Delete the one time events due at or before a time. Recurring events are kept
+
+    :param db:
+    :param before_time: Epoch time
+    """
+    execute(db, "delete_events_before", time=before_time)
+
+
+def active_revocations(db, now):
+    """
+    :param db:
+    :param now:
+    :return rows of token_hash and expires for the revoked tokens that haven't expired yet:
+    """
+    return query(db, "active_revocations", time=now)
+
+
+def delete_revocations_before(db, before_time):
+    """
+    Delete revocations of tokens that have expired
+
+    :param db:
+    :param before_time:
+    """
+    execute(db, "delete_revocations_before", time=before_time)
@@ -0,0 +1,187 @@
+#Builtin imports
+import logging
+
+#External imports
+from sqlalchemy import MetaData, Table, Column, Index, Integer, BigInteger, Float, Boolean, String, Text, inspect
+
+log = logging.getLogger()
+
+metadata = MetaData()
+
+#Indexes on text columns need a prefix length on MySQL, because tables created by dataset store strings as TEXT
+users = Table(
+    "users", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("username", String(128)),
+    Column("password", Text),
+    Column("first_name", Text),
+    Column("last_name", Text),
+    Column("email", Text),
+    Column("admin", Boolean),
+    Column("default_plugin", String(64)),
+    Column("notifications", Text),
+    Column("ip", String(64)),
+    Column("news_site", String(255)),
+    Column("city", String(128)),
+    Column("country", String(128)),
+    Column("state", String(128)),
+    Column("temp_unit", String(32)),
+    Column("timezone", String(64)),
+    Column("user_token", String(128)),
+    Column("chat_id", BigInteger),
+    Index("ix_users_username", "username", unique=True, mysql_length=128),
+    Index("ix_users_user_token", "user_token", mysql_length=128),
+    Index("ix_users_chat_id", "chat_id")
+)
+
+events = Table(
+    "events", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("uid", String(128)),
+    Column("username", String(128)),
+    Column("type", String(32)),
+    Column("time", Float),
+    Column("value", Text),
+    Column("summary", Text),
+    Column("recurrence", String(32)),
+    Index("ix_events_uid", "uid", unique=True, mysql_length=128),
+    Index("ix_events_time", "time")
+)
+
+keys = Table(
+    "keys", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("type", String(64)),
+    Column("num", Integer),
+    Column("value", Text),
+    Column("url", Text),
+    Column("uses", Integer),
+    Column("max_uses", Integer),
+    Index("ix_keys_type_num", "type", "num", unique=True, mysql_length={"type": 64})
+)
+
+news = Table(
+    "news", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("site", String(255)),
+    Column("time", Float),
+    Column("news_str", Text),
+    Index("ix_news_site", "site", unique=True, mysql_length=255)
+)
+
+telegram = Table(
+    "telegram", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("username", String(128)),
+    Column("chat_id", BigInteger),
+    Column("session_id", String(64)),
+    Index("ix_telegram_username", "username", unique=True, mysql_length=128),
+    Index("ix_telegram_chat_id", "chat_id")
+)
+
+#Revoked tokens are stored by their sha256 hash until they would have expired anyway
+revoked_tokens = Table(
+    "revoked_tokens", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("token_hash", String(64)),
+    Column("expires", Float),
+    Index("ix_revoked_tokens_token_hash", "token_hash", unique=True, mysql_length=64),
+    Index("ix_revoked_tokens_expires", "expires")
+)
+
+variables = Table(
+    "vars", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("name", String(128)),
+    Column("value", Text),
+    Index("ix_vars_name", "name", unique=True, mysql_length=128)
+)
+
+
+def create_indexes(db):
+    """
+    Create any missing tables, and add the indexed columns and indexes to tables that already exist.
+    Tables from older deployments were created implicitly by dataset, so they can be missing all of these
+
+    :param db:
+    """
+    engine = db.engine
+    existing_tables = inspect(engine).get_table_names()
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            log.info(":DB:Creating table {0}".format(table.name))
+            table.create(engine)
+            continue
+        table_inspector = inspect(engine)
+        existing_columns = [c["name"] for c in table_inspector.get_columns(table.name)]
+        existing_indexes = [i["name"] for i in table_inspector.get_indexes(table.name)]
+        for index in list(table.indexes):
+            if index.name in existing_indexes:
+                continue
+            for column in index.columns:
+                if column.name not in existing_columns:
+                    log.info(":DB:Adding column {0} to table {1}".format(column.name, table.name))
+                    db[table.name].create_column(column.name, column.type)
+                    existing_columns.append(column.name)
+            log.info(":DB:Creating index {0}".format(index.name))
+            try:
+                index.create(engine)
+            except Exception as index_error:
+                if not index.unique:
+                    raise
+                #Duplicate rows in an existing deployment. Still index the lookup, but without the constraint
+                log.warning(":DB:Couldn't create unique index {0}, creating it without the unique constraint. "
+                            "Error was {1}".format(index.name, index_error))
+                fallback_index = Index(index.name, *index.columns, **index.kwargs)
+                #Keep the fallback out of the table definition so new tables still get the unique index
+                table.indexes.discard(fallback_index)
+                fallback_index.create(engine)
+
+
+def add_event_recurrence(db):
+    """
+    Add the recurrence column that recurring reminders keep their rule in
+
+    :param db:
+    """
+    if "recurrence" not in [c["name"] for c in inspect(db.engine).get_columns("events")]:
+        log.info(":DB:Adding column recurrence to table events")
+        db["events"].create_column("recurrence", String(32))
+
+
+def add_revoked_tokens(db):
+    """
+    Create the table token revocations are kept in, so they survive a restart
+
+    :param db:
+    """
+    if "revoked_tokens" not in inspect(db.engine).get_table_names():
+        log.info(":DB:Creating table revoked_tokens")
+        revoked_tokens.create(db.engine)
+
+
+#Migrations in order. The schema version is the number of migrations that have been run
+migrations = [
+    create_indexes,
+    add_event_recurrence,
+    add_revoked_tokens
+]
+
+
+def migrate(db):
+    """
+    Bring the database schema up to date. Run at startup before anything else uses the database
+
+    :param db:
+    """
+    #The vars table holds the schema version, so make sure it exists and is indexed first
+    if "vars" not in inspect(db.engine).get_table_names():
+        variables.create(db.engine)
+    version_row = db["vars"].find_one(name="schema_version")
+    version = int(version_row["value"]) if version_row else 0
+    log.info(":DB:Schema version is {0}, latest is {1}".format(version, len(migrations)))
+    for migration_num in range(version, len(migrations)):
+        migration = migrations[migration_num]
+        log.info(":DB:Running migration {0}, {1}".format(migration_num+1, migration.__name__))
+        migration(db)
+        db["vars"].upsert(dict(name="schema_version", value=str(migration_num+1)), ["name"])
@@ -0,0 +1,124 @@
+#Builtin imports
+import logging
+import re
+import datetime
+
+log = logging.getLogger()
+
+word_numbers = {
+    "a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8,
+    "nine": 9, "ten": 10, "fifteen": 15, "twenty": 20, "thirty": 30, "forty": 40, "fifty": 50
+}
+
+unit_seconds = {
+    "second": 1, "sec": 1, "minute": 60, "min": 60, "hour": 3600, "hr": 3600, "day": 86400, "week": 604800
+}
+
+relative_part = re.compile(r"^(\d+(?:\.\d+)?|{0})\s+({1})s?$".format(
+    "|".join(word_numbers), "|".join(unit_seconds)))
+
+relative_separator = re.compile(r"\s*(?:,|\band\b)\s*")
+
+extra_characters = re.compile(r"[^\w\s:,.]")
+
+#The only day words the absolute pattern understands
+day_words = ("today", "tonight", "tomorrow")
+
+absolute_time = re.compile(r"^(?:({0})\s+)?(?:at\s+)?(\d{{1,2}})(?::(\d{{2}}))?\s*(am|pm)?(?:\s+({0}))?$".format(
+    "|".join(day_words)))
+
+
+def normalize(text):
+    """
+    Lowercase a time phrase and strip everything the patterns don't use
+
+    :param text:
+    :return normalized text:
+    """
+    text = text.lower().replace("a.m.", "am").replace("p.m.", "pm")
+    return " ".join(extra_characters.sub(" ", text).split()).strip(" .")
+
+
+def parse_relative(text):
+    """
+    Parse phrases like "in 5 minutes", "an hour", or "in 1 hour and 30 minutes"
+
+    :param text: Normalized text
+    :return seconds from now, or None:
+    """
+    if text.startswith("in "):
+        text = text[3:]
+    if text.endswith(" from now"):
+        text = text[:-9]
+    seconds = 0
+    for part in relative_separator.split(text):
+        part_match = relative_part.match(part)
+        if not part_match:
+            return None
+        amount, unit = part_match.groups()
+        amount = word_numbers[amount] if amount in word_numbers else float(amount)
+        seconds += amount*unit_seconds[unit]
+    return seconds
+
+
+def parse_absolute(text, now, tz=None):
+    """
+    Parse phrases like "at 3:00", "3pm", or "tomorrow at 9". Times without am or pm are taken as the next time
+    they come around, on either clock
+
+    :param text: Normalized text
+    :param now: The current time as an aware datetime in the user's timezone
+    :param tz: The user's pytz timezone, used to localize the result across daylight saving changes
+    :return seconds from now, or None:
+    """
+    time_match = absolute_time.match(text)
+    if not time_match:
+        return None
+    day_before, hour, minute, meridiem, day_after = time_match.groups()
+    day_word = day_before or day_after
+    hour = int(hour)
+    minute = int(minute or 0)
+    if minute > 59 or hour > 23 or (meridiem and not 1 <= hour <= 12):
+        return None
+    if meridiem:
+        hour = hour % 12 + (12 if meridiem == "pm" else 0)
+        hours = [hour]
+    elif day_word == "tonight" and hour < 12:
+        hours = [hour+12]
+    elif day_word == "tomorrow" or hour > 12:
+        hours = [hour]
+    else:
+        hours = [hour % 12, hour % 12+12]
+    day = now.date()
+    if day_word == "tomorrow":
+        day += datetime.timedelta(days=1)
+
+    def at(day, hour):
+        naive = datetime.datetime.combine(day, datetime.time(hour, minute))
+        return tz.localize(naive) if tz is not None else naive.replace(tzinfo=now.tzinfo)
+    candidates = [at(day, h) for h in hours]
+    if not day_word:
+        #A time that's already passed today means the next day
+        candidates += [at(day+datetime.timedelta(days=1), h) for h in hours]
+    upcoming = [candidate for candidate in candidates if candidate > now]
+    if not upcoming:
+        return None
+    return (min(upcoming)-now).total_seconds()
+
+
+def parse(text, now, tz=None):
+    """
+    Parse the common reminder time phrases without dateparser
+
+    :param text: The time phrase
+    :param now: The current time as an aware datetime in the user's timezone
+    :param tz: The user's pytz timezone
+    :return seconds from now, or None if the phrase isn't one of the common forms:
+    """
+    text = normalize(text)
+    if not text:
+        return None
+    seconds = parse_relative(text)
+    if seconds is None:
+        seconds = parse_absolute(text, now, tz)
+    return seconds
@@ -0,0 +1,139 @@
+#Builtin imports
+import logging
+import re
+import threading
+
+#Internal imports
+import core.metrics as metrics
+
+log = logging.getLogger()
+
+non_word = re.compile(r"[^\w\s]+", re.UNICODE)
+
+
+def normalize(text):
+    """
+    Lowercase a text and strip its punctuation and extra whitespace
+
+    :param text:
+    :return normalized text:
+    """
+    return " ".join(non_word.sub("", text.lower()).split())
+
+
+def trigrams(text):
+    """
+    Get the character trigrams of a normalized text, padded so short words still have some
+
+    :param text:
+    :return set of trigrams:
+    """
+    padded = "  {0} ".format(text)
+    return set(padded[i:i+3] for i in range(len(padded)-2))
+
+
+class TrigramIndex():
+    '''
+    An inverted index from character trigrams to labels. Lookups return exact matches of the normalized text
+    straight away, and otherwise rank the labels that share trigrams with the query by their Dice similarity.
+    Good for short titles and names that word vectors don't know, and for narrowing down the labels a slower
+    scorer has to look at
+    '''
+    def __init__(self, name, labels=(), near_exact=0.9):
+        self.name = name
+        self.near_exact = near_exact
+        self.lock = threading.Lock()
+        self.exact = {}
+        self.postings = {}
+        self.label_trigrams = {}
+        for label in labels:
+            self.add(label)
+
+    def add(self, label):
+        """
+        Add a label to the index
+
+        :param label:
+        """
+        normalized = normalize(label)
+        label_grams = trigrams(normalized)
+        with self.lock:
+            if label in self.label_trigrams:
+                return
+            self.label_trigrams[label] = label_grams
+            self.exact.setdefault(normalized, []).append(label)
+            for gram in label_grams:
+                self.postings.setdefault(gram, set()).add(label)
+
+    def remove(self, label):
+        """
+        Remove a label from the index
+
+        :param label:
+        """
+        normalized = normalize(label)
+        with self.lock:
+            label_grams = self.label_trigrams.pop(label, None)
+            if label_grams is None:
+                return
+            self.exact[normalized].remove(label)
+            if not self.exact[normalized]:
+                del self.exact[normalized]
+            for gram in label_grams:
+                self.postings[gram].discard(label)
+                if not self.postings[gram]:
+                    del self.postings[gram]
+
+    def update(self, labels):
+        """
+        Change the index to hold exactly the given labels
+
+        :param labels:
+        """
+        labels = set(labels)
+        for label in [l for l in self.label_trigrams if l not in labels]:
+            self.remove(label)
+        for label in labels:
+            self.add(label)
+
+    def __len__(self):
+        return len(self.label_trigrams)
+
+    def lookup(self, query, limit=10, min_score=0.3):
+        """
+        Find the labels that best match a query
+
+        :param query:
+        :param limit: Maximum number of matches
+        :param min_score: Minimum Dice similarity of a match
+        :return dict with the matches as (label, score) pairs, best first, the source of the match (exact,
+        near_exact, candidates, or none), and the number of candidates that were scored:
+        """
+        normalized = normalize(query)
+        with self.lock:
+            exact_labels = list(self.exact.get(normalized, []))
+            if exact_labels:
+                result = {"source": "exact", "matches": [(label, 1.0) for label in exact_labels[:limit]],
+                          "candidates": len(exact_labels)}
+            else:
+                query_grams = trigrams(normalized)
+                overlaps = {}
+                for gram in query_grams:
+                    for label in self.postings.get(gram, ()):
+                        overlaps[label] = overlaps.get(label, 0)+1
+                scored = []
+                for label, overlap in overlaps.items():
+                    score = 2.0*overlap/(len(query_grams)+len(self.label_trigrams[label]))
+                    if score >= min_score:
+                        scored.append((label, score))
+                scored.sort(key=lambda match: -match[1])
+                if not scored:
+                    source = "none"
+                elif scored[0][1] >= self.near_exact:
+                    source = "near_exact"
+                else:
+                    source = "candidates"
+                result = {"source": source, "matches": scored[:limit], "candidates": len(overlaps)}
+        metrics.increment("trigram_{0}:{1}".format(result["source"], self.name))
+        metrics.record("trigram_candidates:{0}".format(self.name), result["candidates"])
+        return result
@@ -0,0 +1,81 @@
+#Builtin imports
+import logging
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
+
+#Internal imports
+import core.metrics as metrics
+
+log = logging.getLogger()
+
+#The most updates a session will hold before the oldest ones are dropped
+max_updates = 100
+
+#Session ids with new updates for a push subscriber, consumed by the socket.io dispatcher
+ready_sessions = Queue.Queue()
+
+
+def initialize(configuration_data):
+    """
+    Load the update queue size from the configuration
+
+    :param configuration_data:
+    """
+    global max_updates
+    max_updates = configuration_data.get("max_session_updates", max_updates)
+
+
+class UpdateQueue(Queue.Queue):
+    '''
+    The updates queue for a session. When a push client is subscribed to the session, every put also
+    wakes the update dispatcher so the update can be emitted immediately.
+
+    The queue is bounded so a client that stops reading can't grow memory forever. An update with the same
+    type and text as the newest queued update is merged into it by incrementing its "repeats" count, and once
+    the queue is full the oldest update is dropped. Puts never block.
+    '''
+    def __init__(self, session_id, max_size=None):
+        Queue.Queue.__init__(self)
+        self.session_id = session_id
+        self.subscribed = False
+        self.max_size = max_size or max_updates
+        self.dropped = 0
+        self.coalesced = 0
+
+    def _put(self, item):
+        #Called with the queue mutex held
+        if self.queue and isinstance(item, dict):
+            newest = self.queue[-1]
+            if isinstance(newest, dict) and "text" in item.keys() and \
+                    newest.get("type") == item.get("type") and newest.get("text") == item["text"]:
+                #The same update dict is put on every session for a user, so merge into a copy
+                merged = dict(newest)
+                merged["repeats"] = newest.get("repeats", 1) + 1
+                self.queue[-1] = merged
+                self.coalesced += 1
+                metrics.increment("updates_coalesced")
+                return
+        if len(self.queue) >= self.max_size:
+            self.queue.popleft()
+            self.dropped += 1
+            metrics.increment("updates_dropped")
+        Queue.Queue._put(self, item)
+        if self.subscribed:
+            ready_sessions.put(self.session_id)
+
+    def drain(self, max_items=None):
+        """
+        Get all of the updates that are currently in the queue without blocking
+
+        :param max_items: Optional - the most updates to return
+        :return list of updates:
+        """
+        drained = []
+        while max_items is None or len(drained) < max_items:
+            try:
+                drained.append(self.get_nowait())
+            except Queue.Empty:
+                break
+        return drained
@@ -0,0 +1,147 @@
+#Builtin imports
+import logging
+import json
+import os
+
+#External imports
+import numpy
+
+log = logging.getLogger()
+
+
+class VectorIndex():
+    '''
+    A set of labelled vectors kept as rows of one normalized matrix, so finding the most similar labels to a
+    vector is a single matrix-vector product. Indexes can be saved and loaded back as a read only memory map
+    '''
+    def __init__(self, labels=None, matrix=None):
+        self.labels = list(labels or [])
+        self.positions = dict((label, i) for i, label in enumerate(self.labels))
+        self.matrix = matrix if matrix is not None else numpy.zeros((0, 0), dtype=numpy.float32)
+
+    @staticmethod
+    def normalize(vectors):
+        """
+        Scale vectors to unit length. Vectors of all zeros, like those of unknown words, are left as they are
+
+        :param vectors: 2d array
+        :return normalized float32 array:
+        """
+        vectors = numpy.asarray(vectors, dtype=numpy.float32)
+        norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors/norms
+
+    @classmethod
+    def build(cls, labels, vector_function):
+        """
+        Build an index
+
+        :param labels:
+        :param vector_function: Takes a label and returns its vector
+        :return VectorIndex:
+        """
+        labels = list(labels)
+        if not labels:
+            return cls()
+        return cls(labels, cls.normalize([vector_function(label) for label in labels]))
+
+    def copy(self):
+        """
+        Get an index with the same labels that can be updated without changing this one. The matrix is shared,
+        since update replaces it rather than changing it in place
+
+        :return VectorIndex:
+        """
+        return VectorIndex(self.labels, self.matrix)
+
+    def update(self, labels, vector_function):
+        """
+        Change the index to hold exactly the given labels, only computing vectors for labels that are new
+
+        :param labels:
+        :param vector_function:
+        :return (number of labels added, number of labels removed):
+        """
+        labels = list(labels)
+        new_labels = [label for label in labels if label not in self.positions]
+        kept_labels = set(labels)
+        removed = len([label for label in self.labels if label not in kept_labels])
+        if not new_labels and not removed:
+            return 0, 0
+        new_rows = self.normalize([vector_function(label) for label in new_labels]) if new_labels else None
+        rows = []
+        new_positions = dict((label, i) for i, label in enumerate(new_labels))
+        for label in labels:
+            if label in self.positions:
+                rows.append(self.matrix[self.positions[label]])
+            else:
+                rows.append(new_rows[new_positions[label]])
+        self.matrix = numpy.array(rows, dtype=numpy.float32)
+        self.labels = labels
+        self.positions = dict((label, i) for i, label in enumerate(labels))
+        return len(new_labels), removed
+
+    def top_k(self, vector, k=1, candidates=None):
+        """
+        Find the labels most similar to a vector by cosine similarity
+
+        :param vector:
+        :param k:
+        :param candidates: Optional labels to limit the search to
+        :return list of (label, similarity), most similar first:
+        """
+        if not self.labels:
+            return []
+        query = numpy.asarray(vector, dtype=numpy.float32)
+        query_norm = numpy.linalg.norm(query)
+        if query_norm == 0:
+            return []
+        query = query/query_norm
+        if candidates is None:
+            labels = self.labels
+            scores = self.matrix.dot(query)
+        else:
+            labels = [label for label in candidates if label in self.positions]
+            if not labels:
+                return []
+            scores = self.matrix[[self.positions[label] for label in labels]].dot(query)
+        k = min(k, len(labels))
+        if k == 1:
+            best = [int(numpy.argmax(scores))]
+        else:
+            best = numpy.argpartition(-scores, k-1)[:k]
+            best = sorted(best, key=lambda i: -scores[i])
+        return [(labels[i], float(scores[i])) for i in best]
+
+    def save(self, path):
+        """
+        Save the index as path.npy and path.json. The files are written under temporary names and renamed into
+        place, so an index that has the old matrix memory mapped keeps reading the old file
+
+        :param path:
+        """
+        numpy.save("{0}.tmp.npy".format(path), numpy.asarray(self.matrix, dtype=numpy.float32))
+        with open("{0}.tmp.json".format(path), 'w') as labels_file:
+            json.dump(self.labels, labels_file)
+        replace = getattr(os, "replace", os.rename)
+        replace("{0}.tmp.npy".format(path), "{0}.npy".format(path))
+        replace("{0}.tmp.json".format(path), "{0}.json".format(path))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a saved index, memory mapping the matrix
+
+        :param path:
+        :return VectorIndex, or None if it hasn't been saved:
+        """
+        if not (os.path.isfile("{0}.npy".format(path)) and os.path.isfile("{0}.json".format(path))):
+            return None
+        with open("{0}.json".format(path)) as labels_file:
+            labels = json.load(labels_file)
+        matrix = numpy.load("{0}.npy".format(path), mmap_mode='r')
+        if matrix.shape[0] != len(labels):
+            log.warning(":VECTORS:Saved index {0} doesn't match its labels, ignoring it".format(path))
+            return None
+        return cls(labels, matrix)
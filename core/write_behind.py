@@ -0,0 +1,257 @@
+#Builtin imports
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+#Internal imports
+import core.metrics as metrics
+
+log = logging.getLogger()
+
+writer = None
+
+#Tables whose queued writes are never dropped
+durable_tables = ("events",)
+
+
+class WriteBehind():
+    '''
+    Collects upserts whose results no response depends on and commits them in batched transactions from a
+    background thread. Repeated upserts to the same row are merged while they wait, and the buffer is bounded:
+    when it's full, writes go straight to the database instead of queueing. When a batch fails its rows are
+    retried one at a time, and a row that fails max_attempts flushes in a row is dropped, except for rows of the
+    durable tables, which are kept until they're written. Rows being written are kept in flight, so pending_row
+    still sees them until their transaction commits
+    '''
+    def __init__(self, db, max_pending=10000, flush_interval=1.0, batch_size=500, max_attempts=5):
+        self.db = db
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        #Failed flushes of each queued row
+        self.attempts = {}
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = OrderedDict()
+        #Rows taken from pending by a flush that hasn't committed them yet
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = False
+
+    @staticmethod
+    def _row_key(table, row, keys):
+        keys = sorted(keys)
+        return (table, tuple(keys), tuple(row[k] for k in keys))
+
+    def upsert(self, table, row, keys):
+        """
+        Queue an upsert
+
+        :param table: Table name
+        :param row: Row data
+        :param keys: The columns that identify the row
+        """
+        row_key = self._row_key(table, row, keys)
+        with self.lock:
+            if row_key in self.pending:
+                self.pending[row_key].update(row)
+                metrics.increment("write_behind_coalesced")
+                return
+            if len(self.pending) < self.max_pending:
+                self.pending[row_key] = dict(row)
+                metrics.increment("write_behind_queued")
+                if len(self.pending) >= self.batch_size:
+                    self.wakeup.set()
+                return
+        #The buffer is full, so write through rather than grow it
+        metrics.increment("write_behind_overflow")
+        self.db[table].upsert(row, keys)
+
+    def pending_row(self, table, key_values):
+        """
+        Get the queued changes to a row that haven't been written yet, so readers can see their own writes
+
+        :param table: Table name
+        :param key_values: Dict of the key columns and their values
+        :return dict of queued changes, or None:
+        """
+        row_key = self._row_key(table, key_values, key_values.keys())
+        with self.lock:
+            flushing = self.in_flight.get(row_key)
+            queued = self.pending.get(row_key)
+            if flushing is None and queued is None:
+                return None
+            changes = dict(flushing or {})
+            #Anything queued since the flush started is newer
+            changes.update(queued or {})
+            return changes
+
+    def flush(self):
+        """
+        Write queued upserts in batches until the buffer is empty
+
+        """
+        with self.flush_lock:
+            while True:
+                with self.lock:
+                    batch = []
+                    while self.pending and len(batch) < self.batch_size:
+                        row_key, row = self.pending.popitem(last=False)
+                        self.in_flight[row_key] = row
+                        batch.append((row_key, row))
+                if not batch:
+                    return
+                start_time = time.time()
+                self.db.begin()
+                try:
+                    for (table, keys, key_values), row in batch:
+                        self.db[table].upsert(row, list(keys))
+                    self.db.commit()
+                except Exception as flush_error:
+                    self.db.rollback()
+                    metrics.increment("write_behind_errors")
+                    log.error(":DB:Error {0} while flushing {1} queued writes, retrying them one at a time".format(
+                        flush_error, len(batch)))
+                    failed = self._write_rows(batch)
+                    self._requeue(failed)
+                    if failed:
+                        #Leave the rest of the buffer for the next flush
+                        return
+                    continue
+                with self.lock:
+                    for row_key, row in batch:
+                        self.attempts.pop(row_key, None)
+                        self.in_flight.pop(row_key, None)
+                metrics.increment("write_behind_flushed", len(batch))
+                metrics.record("write_behind_flush", (time.time()-start_time)*1000, percentiles=True)
+
+    def _write_rows(self, batch):
+        """
+        Write the rows of a failed batch one at a time, so one bad row doesn't hold back the others
+
+        :param batch: List of (row key, row)
+        :return list of the (row key, row, error) that still failed:
+        """
+        failed = []
+        for row_key, row in batch:
+            table, keys, key_values = row_key
+            try:
+                self.db[table].upsert(row, list(keys))
+            except Exception as row_error:
+                failed.append((row_key, row, row_error))
+                continue
+            with self.lock:
+                self.attempts.pop(row_key, None)
+                self.in_flight.pop(row_key, None)
+            metrics.increment("write_behind_flushed")
+        return failed
+
+    def _requeue(self, failed):
+        """
+        Put rows that failed back in the buffer. Rows of the durable tables are always kept. Other rows are dropped
+        once they've failed max_attempts times or when they don't fit in the buffer
+
+        :param failed: List of (row key, row, error)
+        """
+        with self.lock:
+            for row_key, row, row_error in failed:
+                self.in_flight.pop(row_key, None)
+                attempts = self.attempts.get(row_key, 0)+1
+                self.attempts[row_key] = attempts
+                if row_key in self.pending:
+                    #Merge into the newer queued change without moving it or growing the buffer
+                    row.update(self.pending[row_key])
+                    self.pending[row_key] = row
+                elif row_key[0] in durable_tables:
+                    #Losing these loses a user's data, like a reminder, so they're retried until they're written
+                    self.pending[row_key] = row
+                    if attempts % self.max_attempts == 0:
+                        log.error(":DB:Write to {0} {1} has failed {2} times, keeping it queued. Last error was "
+                                  "{3}".format(row_key[0], row, attempts, row_error))
+                elif attempts >= self.max_attempts or len(self.pending) >= self.max_pending:
+                    self.attempts.pop(row_key, None)
+                    metrics.increment("write_behind_dropped")
+                    reason = "after {0} failed attempts".format(attempts) if attempts >= self.max_attempts else \
+                        "because the buffer is full"
+                    log.error(":DB:Dropping queued write to {0} {1} {2}. Last error was {3}".format(
+                        row_key[0], row, reason, row_error))
+                else:
+                    self.pending[row_key] = row
+
+    def run(self):
+        """
+        Flush the buffer every flush_interval seconds, or sooner when a full batch is waiting
+
+        """
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            metrics.record("write_behind_pending", len(self.pending))
+            try:
+                self.flush()
+            except Exception as flush_error:
+                log.error(":DB:Error {0} in write behind loop".format(flush_error))
+
+    def start(self):
+        """
+        Start the flush thread
+
+        """
+        self.running = True
+        flush_thread = threading.Thread(target=self.run)
+        flush_thread.daemon = True
+        flush_thread.start()
+
+
+def initialize(db, configuration_data):
+    """
+    Start the write behind buffer
+
+    :param db:
+    :param configuration_data:
+    """
+    global writer
+    writer = WriteBehind(
+        db,
+        max_pending=configuration_data.get("write_behind_max_pending", 10000),
+        flush_interval=configuration_data.get("write_behind_interval", 1.0),
+        max_attempts=configuration_data.get("write_behind_max_attempts", 5)
+    )
+    writer.start()
+
+
+def upsert(db, table, row, keys):
+    """
+    Queue an upsert, or write it directly if the write behind buffer isn't running
+
+    :param db:
+    :param table:
+    :param row:
+    :param keys:
+    """
+    if writer is None:
+        db[table].upsert(row, keys)
+    else:
+        writer.upsert(table, row, keys)
+
+
+def pending_row(table, key_values):
+    """
+    :param table:
+    :param key_values:
+    :return queued changes to a row that haven't been written yet, or None:
+    """
+    if writer is None:
+        return None
+    return writer.pending_row(table, key_values)
+
+
+def flush():
+    """
+    Write everything that's queued, used on shutdown
+
+    """
+    if writer is not None:
+        writer.flush()
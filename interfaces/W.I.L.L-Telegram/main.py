@@ -7,7 +7,6 @@ import threading
 
 #External imports
 import telegram
-#from socketIO_client import SocketIO, LoggingNamespace, BaseNamespace
 from telegram.ext import (
 Updater, CommandHandler, MessageHandler, Filters
 )
@@ -48,14 +47,26 @@ def help(bot, update):
     '''Echo the help string'''
     bot.sendMessage(update.message.chat_id, help_str)
 
-#def socket_io_thread(bot,session_id, chat_id ):
-#    socketIO = SocketIO(SERVER_URL, 80)
-#    log.info("In socket_io thread")
-#    socketIO.on('connect', lambda: socketIO.emit("get_updates", session_id))
-#    socketIO.on('update', lambda x: bot.sendMessage(chat_id, (x["value"])))
-#    socketIO.on('disconnect', lambda x: bot.sendMessage(chat_id, "Update server has disconnected"))
-#    socketIO.on('debug', lambda x: log.info("Got debug message {0} from socketIO".format(x["value"])))
-#    socketIO.wait()
+def update_thread(bot, session_id, chat_id):
+    '''Long poll the W.I.L.L server for updates to the session and send them to the chat'''
+    log.info("Starting update thread for chat {0}".format(chat_id))
+    while True:
+        try:
+            response = requests.post(
+                url="{0}/api/updates".format(SERVER_URL),
+                data={"session_id": session_id, "timeout": 30},
+                timeout=45
+            ).json()
+        except Exception as update_exception:
+            log.info("Caught exception {0} while polling for updates, retrying".format(update_exception))
+            time.sleep(5)
+            continue
+        if response["type"] != "success":
+            log.info("Stopping update thread for chat {0}: {1}".format(chat_id, response["text"]))
+            break
+        for session_update in response["data"]["updates"]:
+            if "text" in session_update.keys() and session_update["text"]:
+                bot.sendMessage(chat_id, session_update["text"])
 
 def login(bot, update):
     '''Login to W.I.L.L and store the session id in the db'''
@@ -74,10 +85,10 @@ def login(bot, update):
             username=username, chat_id=update.message.chat_id, session_id=response["data"]["session_id"])
             , ['username']
         )
-        #socket_thread = threading.Thread(target=socket_io_thread, args=(
-        #   bot, response["data"]["session_id"],update.message.chat_id))
-        #TODO: fix this later
-        #socket_thread.start()
+        poll_thread = threading.Thread(target=update_thread, args=(
+           bot, response["data"]["session_id"], update.message.chat_id))
+        poll_thread.daemon = True
+        poll_thread.start()
     else:
         log.info("Got error logging in with user {0}. Error text is {1}".format(username, response["text"]))
         update.message.reply_text(response["text"])
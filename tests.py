@@ -3,8 +3,33 @@ import tools
 import json
 import os
 import dataset
+import sqlalchemy
+import core
 import core.plugin_handler as plugin_handler
+import core.parser as parser
 import core.notification as notification
+import core.rate_limit as rate_limit
+import core.metrics as metrics
+import core.keys as keys
+import core.auth as auth
+import core.schema as schema
+import core.updates as updates
+import core.registry as registry
+import core.write_behind as write_behind
+import core.repository as repository
+import core.cache as cache
+import core.vectors as vectors
+import core.trigrams as trigrams
+import core.timeparse as timeparse
+import API
+import web
+from flask import Flask
+import datetime
+import time
+import sys
+import importlib
+import threading
+import pytz
 import logging
 
 logging.basicConfig(filename="unittests.log", level=logging.DEBUG)
@@ -86,5 +111,626 @@ class notification_send(unittest.TestCase):
              "value": "This is a sample reminder that also tests the 5 word summary"},
             db)
 
+class rate_limit_tests(unittest.TestCase):
+    def test_token_bucket(self):
+        bucket = rate_limit.TokenBucket(1, 2)
+        now = bucket.last
+        self.assertTrue(bucket.take(now))
+        self.assertTrue(bucket.take(now))
+        self.assertFalse(bucket.take(now))
+        #A second later one more token is available
+        self.assertTrue(bucket.take(now+1))
+        self.assertFalse(bucket.take(now+1))
+    def test_user_limit(self):
+        rate_limit.buckets.clear()
+        user_limits = rate_limit.limits["user"]
+        allowed = [rate_limit.allow(username="rate_limit_test") for i in range(int(user_limits["burst"])+1)]
+        self.assertEqual(allowed[-1], "user")
+        self.assertTrue(all(x is None for x in allowed[:-1]))
+    def test_ip_limit(self):
+        rate_limit.buckets.clear()
+        ip_limits = rate_limit.limits["ip"]
+        allowed = [rate_limit.allow(client_ip="203.0.113.7") for i in range(int(ip_limits["burst"])+1)]
+        self.assertEqual(allowed[-1], "ip")
+        #Another address and an authenticated user are still allowed
+        self.assertEqual(rate_limit.allow(client_ip="203.0.113.8"), None)
+        self.assertEqual(rate_limit.allow(username="rate_limit_test"), None)
+    def test_unknown_scope(self):
+        rate_limit.initialize({"rate_limits": {"not_a_scope": {"rate": 1}, "user": {"rate": 2, "burst": 10}}})
+        self.assertNotIn("not_a_scope", rate_limit.limits)
+
+class auth_token_tests(unittest.TestCase):
+    def setUp(self):
+        auth.secret_key = b"auth_token_tests"
+        auth.db = None
+        auth.verified_tokens.clear()
+        auth.revoked_tokens.clear()
+    def test_issue_and_verify(self):
+        token = auth.issue_token("token_test")
+        self.assertEqual(auth.verify_token(token), "token_test")
+        #Tokens issued before a restart are checked by their signature
+        auth.verified_tokens.clear()
+        self.assertEqual(auth.verify_token(token), "token_test")
+        payload, signature = token.split(".")
+        self.assertEqual(auth.verify_token("{0}.{1}".format(payload, "0"*len(signature))), None)
+        self.assertEqual(auth.verify_token("not a token"), None)
+    def test_username_with_separator(self):
+        token = auth.issue_token("token|test")
+        auth.verified_tokens.clear()
+        self.assertEqual(auth.verify_token(token), "token|test")
+    def test_expiry(self):
+        auth.token_ttl = -1
+        try:
+            token = auth.issue_token("token_test")
+        finally:
+            auth.token_ttl = 3600
+        self.assertEqual(auth.verify_token(token), None)
+        auth.verified_tokens.clear()
+        self.assertEqual(auth.verify_token(token), None)
+    def test_prune(self):
+        auth.verified_tokens["expired"] = ("token_test", 0)
+        auth.last_prune = 0
+        auth.issue_token("token_test")
+        self.assertNotIn("expired", auth.verified_tokens)
+    def test_revoke(self):
+        schema.add_revoked_tokens(db)
+        auth.db = db
+        token = auth.issue_token("token_test")
+        auth.revoke_token(token)
+        self.assertEqual(auth.verify_token(token), None)
+        #The revocation is stored, so it still holds after a restart
+        auth.verified_tokens.clear()
+        auth.revoked_tokens.clear()
+        for revocation_row in repository.active_revocations(db, 0):
+            auth.revoked_tokens[revocation_row["token_hash"]] = revocation_row["expires"]
+        self.assertEqual(auth.verify_token(token), None)
+        db["revoked_tokens"].delete(token_hash=auth._token_hash(token))
+        auth.db = None
+
+class time_series_tests(unittest.TestCase):
+    def test_rollup_and_percentiles(self):
+        time_series = metrics.TimeSeries(percentiles=True)
+        now = 3600*1000
+        for value in range(1, 11):
+            time_series.record(value, now=now)
+        time_series.record(100, now=now+1)
+        seconds = time_series.history("second", points=2, now=now+1)
+        self.assertEqual([point["count"] for point in seconds], [10, 1])
+        self.assertEqual(seconds[0]["sum"], 55)
+        self.assertEqual(seconds[0]["max"], 10)
+        self.assertEqual(seconds[0]["last"], 10)
+        #Percentiles are the upper bounds of the histogram buckets they fall in
+        self.assertEqual(seconds[0]["p50"], 5)
+        self.assertEqual(seconds[0]["p90"], 10)
+        #Both seconds roll up into the same minute and hour
+        minute = time_series.history("minute", points=1, now=now+1)[0]
+        self.assertEqual(minute["count"], 11)
+        self.assertEqual(minute["max"], 100)
+        self.assertEqual(time_series.history("hour", points=1, now=now+1)[0]["count"], 11)
+        #Old slots are reused once they've rolled out of the ring
+        self.assertEqual(time_series.history("second", points=1, now=now+600)[0]["count"], 0)
+        time_series.record(1, now=now+600)
+        self.assertEqual(time_series.history("second", points=1, now=now+600)[0]["count"], 1)
+
+class key_rotator_tests(unittest.TestCase):
+    def setUp(self):
+        for num, uses in enumerate([5, 2, 11]):
+            db["keys"].upsert(dict(type="rotator_test", num=num, value="key_{0}".format(num), uses=uses,
+                                   max_uses=10), ["type", "num"])
+        self.rotator = keys.KeyRotator(db)
+    def tearDown(self):
+        db["keys"].delete(type="rotator_test")
+    def test_least_used(self):
+        self.assertEqual(self.rotator.use("rotator_test")["num"], 1)
+        self.assertEqual(db["keys"].find_one(type="rotator_test", num=1)["uses"], 3)
+        #Key 1 stays the least used until it catches up with key 0
+        self.assertEqual([self.rotator.use("rotator_test")["num"] for i in range(3)], [1, 1, 0])
+    def test_exhausted(self):
+        #Key 2 is already used up, so it's never handed out
+        used = [self.rotator.use("rotator_test")["num"] for i in range(15)]
+        self.assertNotIn(2, used)
+        self.assertRaises(keys.KeysExhausted, self.rotator.use, "rotator_test")
+    def test_monthly_reset(self):
+        reset_row = db["vars"].find_one(name="keys_reset_month")
+        #Only reset the test keys
+        self.rotator.heaps = {"rotator_test": self.rotator.heaps["rotator_test"]}
+        db["vars"].upsert(dict(name="keys_reset_month", value="2000-01"), ["name"])
+        self.rotator.month = None
+        try:
+            self.assertEqual(self.rotator.use("rotator_test")["uses"], 1)
+            self.assertEqual(sorted(row["uses"] for row in db["keys"].find(type="rotator_test")), [0, 0, 1])
+            self.assertEqual(db["vars"].find_one(name="keys_reset_month")["value"],
+                             datetime.date.today().strftime("%Y-%m"))
+        finally:
+            if reset_row:
+                db["vars"].upsert(dict(name="keys_reset_month", value=reset_row["value"]), ["name"])
+
+class update_queue_tests(unittest.TestCase):
+    def test_coalesce(self):
+        update_queue = updates.UpdateQueue("test_session", 10)
+        for i in range(3):
+            update_queue.put({"type": "notification", "text": "Reminder", "data": {}})
+        queued = update_queue.drain()
+        self.assertEqual(len(queued), 1)
+        self.assertEqual(queued[0]["repeats"], 3)
+        self.assertEqual(update_queue.coalesced, 2)
+    def test_drop_oldest(self):
+        update_queue = updates.UpdateQueue("test_session", 2)
+        for i in range(3):
+            update_queue.put({"type": "event", "text": str(i), "data": {}})
+        self.assertEqual([x["text"] for x in update_queue.drain()], ["1", "2"])
+        self.assertEqual(update_queue.dropped, 1)
+
+class update_endpoint_tests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        app = Flask(__name__)
+        app.register_blueprint(API.api, url_prefix="/api")
+        cls.app = app
+        cls.client = app.test_client()
+    def setUp(self):
+        API.configuration_data = {"updates_max_timeout": 1, "updates_batch_size": 50}
+        rate_limit.buckets.clear()
+        self.session_id = "update_endpoint_test"
+        core.sessions[self.session_id] = {"username": "update_endpoint_test", "client": "API-POST",
+                                          "updates": updates.UpdateQueue(self.session_id)}
+    def tearDown(self):
+        core.sessions.pop(self.session_id, None)
+    def test_long_poll(self):
+        core.sessions[self.session_id]["updates"].put({"type": "event", "text": "update", "data": {}})
+        response = self.client.post("/api/updates", json={"session_id": self.session_id, "timeout": 1})
+        self.assertEqual([u["text"] for u in json.loads(response.data)["data"]["updates"]], ["update"])
+        #An empty queue returns once the timeout passes, and a negative timeout doesn't wait at all
+        response = self.client.post("/api/updates", json={"session_id": self.session_id, "timeout": -5})
+        self.assertEqual(json.loads(response.data)["data"]["updates"], [])
+    def test_long_poll_bad_timeout(self):
+        for timeout in ("nan", "inf", "-inf", "soon"):
+            response = self.client.post("/api/updates", json={"session_id": self.session_id, "timeout": timeout})
+            self.assertEqual(response.status_code, 400)
+    def test_stream(self):
+        core.sessions[self.session_id]["updates"].put({"type": "event", "text": "streamed", "data": {}})
+        response = self.client.get("/api/updates/stream?session_id={0}&timeout=1".format(self.session_id),
+                                   buffered=False)
+        stream = iter(response.response)
+        first_event = next(stream)
+        first_event = first_event.decode('utf8') if isinstance(first_event, bytes) else first_event
+        self.assertTrue(first_event.startswith("data: "))
+        self.assertEqual(json.loads(first_event[6:])["text"], "streamed")
+        #Idle streams send keepalives
+        keepalive = next(stream)
+        self.assertIn("keepalive", keepalive.decode('utf8') if isinstance(keepalive, bytes) else keepalive)
+        response.close()
+    def test_non_object_body(self):
+        #Admission control ignores json bodies that aren't objects instead of failing on them
+        for body in ([1, 2], "session_id", 5):
+            with self.app.test_request_context("/api/updates", method="POST", json=body):
+                self.assertEqual(API.limit_requests(), None)
+    def test_stream_bad_timeout(self):
+        response = self.client.get("/api/updates/stream?session_id={0}&timeout=nan".format(self.session_id))
+        self.assertEqual(response.status_code, 400)
+
+class FakeSocketIO():
+    def __init__(self):
+        self.emitted = []
+    def emit(self, event, data, room=None):
+        self.emitted.append((event, data, room))
+
+class dispatcher_tests(unittest.TestCase):
+    def setUp(self):
+        self.saved_socketio = web.socketio
+        web.socketio = FakeSocketIO()
+        self.session_id = "dispatcher_test"
+        core.sessions[self.session_id] = {"username": "dispatcher_test", "client": "WEB",
+                                          "updates": updates.UpdateQueue(self.session_id)}
+    def tearDown(self):
+        web.socketio = self.saved_socketio
+        core.sessions.pop(self.session_id, None)
+        web.update_subscribers.pop(self.session_id, None)
+    def test_routing(self):
+        session_updates = core.sessions[self.session_id]["updates"]
+        session_updates.put({"type": "notification", "text": "first", "data": {}})
+        #Update types the dispatcher doesn't know are passed through as they are
+        session_updates.put({"type": "unknown_type", "text": "second", "data": {}})
+        #Without a subscriber nothing is emitted and the updates stay queued
+        self.assertEqual(web.dispatch_session(self.session_id), 0)
+        self.assertEqual(session_updates.qsize(), 2)
+        web.update_subscribers[self.session_id] = set(["test_sid"])
+        self.assertEqual(web.dispatch_session(self.session_id), 2)
+        self.assertEqual([(event, data["text"], room) for event, data, room in web.socketio.emitted],
+                         [("update", "first", self.session_id), ("update", "second", self.session_id)])
+        self.assertTrue(session_updates.empty())
+    def test_finished_session(self):
+        web.update_subscribers[self.session_id] = set(["test_sid"])
+        core.sessions.pop(self.session_id)
+        self.assertEqual(web.dispatch_session(self.session_id), 0)
+        self.assertNotIn(self.session_id, web.update_subscribers)
+        self.assertEqual(web.socketio.emitted, [])
+    def test_invalid_subscription(self):
+        web.get_updates({"session_id": "not_a_session"})
+        self.assertEqual(web.socketio.emitted, [("update", {"value": "Error, invalid session id"}, None)])
+
+class session_registry_tests(unittest.TestCase):
+    def test_aggregates(self):
+        sessions = registry.SessionRegistry()
+        sessions.update({"a": {"username": "user_a", "client": "WEB"}})
+        sessions["b"] = {"username": "user_a", "client": "API-POST"}
+        sessions["c"] = {"username": "user_b", "client": "WEB"}
+        self.assertEqual(sessions.users_online(), 2)
+        self.assertEqual(sessions.stats()["clients"], {"WEB": 2, "API-POST": 1})
+        del sessions["a"]
+        sessions.pop("c")
+        self.assertEqual(sessions.online_users(), ["user_a"])
+        self.assertEqual(sessions.stats()["active_sessions"], 1)
+
+class write_behind_tests(unittest.TestCase):
+    def test_coalesce_and_flush(self):
+        writer = write_behind.WriteBehind(db, max_pending=10)
+        writer.upsert("vars", {"name": "write_behind_test", "value": "1"}, ["name"])
+        writer.upsert("vars", {"name": "write_behind_test", "value": "2"}, ["name"])
+        self.assertEqual(len(writer.pending), 1)
+        self.assertEqual(writer.pending_row("vars", {"name": "write_behind_test"})["value"], "2")
+        writer.flush()
+        self.assertEqual(writer.pending_row("vars", {"name": "write_behind_test"}), None)
+        self.assertEqual(db["vars"].find_one(name="write_behind_test")["value"], "2")
+        db["vars"].delete(name="write_behind_test")
+    def test_bad_row_dropped(self):
+        writer = write_behind.WriteBehind(db, max_pending=10, max_attempts=2)
+        writer.upsert("vars", {"name": "write_behind_good", "value": "1"}, ["name"])
+        #Values of unsupported types fail on every database
+        writer.upsert("vars", {"name": "write_behind_bad", "value": object()}, ["name"])
+        writer.flush()
+        #The good row is written even though its batch failed, and only the bad row is retried
+        self.assertEqual(db["vars"].find_one(name="write_behind_good")["value"], "1")
+        self.assertEqual(len(writer.pending), 1)
+        writer.flush()
+        self.assertEqual(len(writer.pending), 0)
+        self.assertEqual(writer.attempts, {})
+        db["vars"].delete(name="write_behind_good")
+        db["vars"].delete(name="write_behind_bad")
+    def test_in_flight_rows_visible(self):
+        seen = []
+        class WatchedDB():
+            #Records what readers see while the flush is writing
+            def __getitem__(self, table):
+                seen.append(writer.pending_row("vars", {"name": "write_behind_test"}))
+                return db[table]
+            def __getattr__(self, name):
+                return getattr(db, name)
+        writer = write_behind.WriteBehind(WatchedDB(), max_pending=10)
+        writer.upsert("vars", {"name": "write_behind_test", "value": "1"}, ["name"])
+        writer.flush()
+        self.assertEqual(seen[0]["value"], "1")
+        self.assertEqual(writer.pending_row("vars", {"name": "write_behind_test"}), None)
+        db["vars"].delete(name="write_behind_test")
+    def test_durable_rows_kept(self):
+        writer = write_behind.WriteBehind(db, max_pending=10, max_attempts=1)
+        writer.upsert("events", {"uid": "write_behind_bad", "value": object()}, ["uid"])
+        writer.flush()
+        writer.flush()
+        #Events are never dropped, however often they fail
+        self.assertEqual(len(writer.pending), 1)
+        self.assertEqual(writer.attempts[("events", ("uid",), ("write_behind_bad",))], 2)
+
+class schema_tests(unittest.TestCase):
+    def setUp(self):
+        self.path = "schema_test.db"
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.legacy_db = dataset.connect("sqlite:///{0}".format(self.path))
+        #Tables as older deployments have them, created implicitly by dataset, with a duplicated username
+        self.legacy_db["users"].insert(dict(username="schema_test", first_name="a"))
+        self.legacy_db["users"].insert(dict(username="schema_test", first_name="b"))
+        self.legacy_db["events"].insert(dict(uid="schema_test", username="schema_test", type="notification",
+                                             time=0.0, value="test"))
+    def tearDown(self):
+        self.legacy_db.engine.dispose()
+        #SQLite can leave its journal files next to the database
+        for path in (self.path, self.path+"-wal", self.path+"-shm"):
+            if os.path.isfile(path):
+                os.remove(path)
+    def get_indexes(self, table):
+        return dict((index["name"], index) for index in
+                    sqlalchemy.inspect(self.legacy_db.engine).get_indexes(table))
+    def test_migrate_legacy(self):
+        schema.migrate(self.legacy_db)
+        self.assertEqual(self.legacy_db["vars"].find_one(name="schema_version")["value"],
+                         str(len(schema.migrations)))
+        #The duplicate usernames can't have a unique index, so the lookup is indexed without one
+        users_indexes = self.get_indexes("users")
+        self.assertFalse(users_indexes["ix_users_username"]["unique"])
+        self.assertIn("user_token", self.legacy_db["users"].columns)
+        self.assertTrue(self.get_indexes("events")["ix_events_uid"]["unique"])
+        self.assertIn("recurrence", self.legacy_db["events"].columns)
+        self.assertIn("revoked_tokens", self.legacy_db.tables)
+        self.assertEqual(self.legacy_db["users"].count(), 2)
+    def test_migrate_twice(self):
+        schema.migrate(self.legacy_db)
+        indexes = dict((table, self.get_indexes(table)) for table in ("users", "events", "keys"))
+        schema.migrate(self.legacy_db)
+        self.assertEqual(dict((table, self.get_indexes(table)) for table in indexes), indexes)
+        self.assertEqual(self.legacy_db["vars"].find_one(name="schema_version")["value"],
+                         str(len(schema.migrations)))
+
+class event_window_tests(unittest.TestCase):
+    def test_stream_events(self):
+        start = 4000000000
+        for i in range(5):
+            db["events"].upsert(dict(uid="window_test_{0}".format(i), username="window_test", type="notification",
+                                     time=start+i, value="test"), ['uid'])
+        streamed = [e["uid"] for e in repository.stream_events(db, start, start+2, chunk_size=1)]
+        self.assertEqual(sorted(streamed), ["window_test_1", "window_test_2"])
+        db["events"].delete(username="window_test")
+    def test_add_during_load(self):
+        now = time.time()
+        core.loaded_until = now
+        later_event = {"uid": "window_test_later", "username": "window_test", "type": "notification",
+                       "time": now+60, "value": "test"}
+        core.add_event(later_event, db)
+        #Past the loaded window the event is only stored, until the next load pages it in
+        self.assertNotIn(later_event, core.events)
+        core.load_events(db)
+        self.assertIn("window_test_later", [e["uid"] for e in core.events])
+        #An event added while a load holds the lock waits for the load, then sees the new window
+        raced_event = dict(later_event, uid="window_test_raced", time=now+120)
+        core.events_lock.acquire()
+        add_thread = threading.Thread(target=core.add_event, args=(raced_event, db))
+        add_thread.start()
+        add_thread.join(0.1)
+        self.assertTrue(add_thread.is_alive())
+        core.loaded_until = now+core.event_horizon
+        core.events_lock.release()
+        add_thread.join()
+        self.assertIn(raced_event, core.events)
+        core.events[:] = [e for e in core.events if e.get("username") != "window_test"]
+        db["events"].delete(username="window_test")
+
+class cache_tests(unittest.TestCase):
+    def test_stale_and_lru(self):
+        test_cache = cache.TTLCache("test", 10, max_size=2)
+        test_cache.set("a", 1, stored_at=100)
+        self.assertEqual(test_cache.lookup("a", now=105), (1, True))
+        self.assertEqual(test_cache.lookup("a", now=115), (1, False))
+        test_cache.set("b", 2)
+        test_cache.set("c", 3)
+        self.assertEqual(test_cache.lookup("a"), (None, False))
+        self.assertEqual(test_cache.stats()["evictions"], 1)
+        #One fresh hit, one stale hit, and one miss
+        self.assertEqual(test_cache.stats()["hit_ratio"], 1/3.0)
+        self.assertEqual(test_cache.stats()["stale_ratio"], 1/3.0)
+        self.assertEqual(test_cache.expires_at("b"), test_cache.entries["b"][1]+10)
+    def test_dump_and_purge(self):
+        test_cache = cache.TTLCache("test", 10)
+        test_cache.set("who invent python", "Guido van Rossum")
+        test_cache.set("stale", "old", stored_at=0)
+        restored_cache = cache.TTLCache("test", 10)
+        restored_cache.load(test_cache.dump())
+        self.assertEqual(restored_cache.get("who invent python"), "Guido van Rossum")
+        self.assertEqual(restored_cache.stats()["size"], 1)
+        self.assertEqual(restored_cache.purge("who"), 1)
+    def test_single_flight(self):
+        flight = cache.SingleFlight()
+        self.assertEqual(flight.do("key", lambda x: x*2, 2), 4)
+        self.assertFalse(flight.in_flight("key"))
+
+class vector_index_tests(unittest.TestCase):
+    def test_top_k_and_update(self):
+        title_vectors = {"a": [1, 0, 0], "b": [0, 1, 0], "c": [1, 1, 0]}
+        index = vectors.VectorIndex.build(["a", "b"], title_vectors.get)
+        self.assertEqual(index.top_k([2, 0.1, 0])[0][0], "a")
+        computed = []
+        index.update(["b", "c"], lambda label: computed.append(label) or title_vectors[label])
+        self.assertEqual(computed, ["c"])
+        self.assertEqual([label for label, score in index.top_k([1, 0.9, 0], 2)], ["c", "b"])
+    def test_copy_and_save(self):
+        title_vectors = {"a": [1, 0, 0], "b": [0, 1, 0]}
+        index = vectors.VectorIndex.build(["a"], title_vectors.get)
+        updated = index.copy()
+        updated.update(["a", "b"], title_vectors.get)
+        #Updating the copy leaves the live index as it was
+        self.assertEqual(index.labels, ["a"])
+        self.assertEqual(index.matrix.shape[0], 1)
+        path = "vector_index_test"
+        index.save(path)
+        loaded = vectors.VectorIndex.load(path)
+        #Saving over a memory mapped index doesn't change what it reads
+        updated.save(path)
+        self.assertEqual(loaded.top_k([1, 0, 0])[0][0], "a")
+        self.assertEqual(vectors.VectorIndex.load(path).labels, ["a", "b"])
+        del loaded
+        os.remove("{0}.npy".format(path))
+        os.remove("{0}.json".format(path))
+
+class trigram_index_tests(unittest.TestCase):
+    def test_lookup(self):
+        index = trigrams.TrigramIndex("test", ["Breaking Bad", "Better Call Saul", "The Office"])
+        self.assertEqual(index.lookup("breaking bad!")["source"], "exact")
+        misspelled = index.lookup("Breking Bad")
+        self.assertEqual(misspelled["matches"][0][0], "Breaking Bad")
+        self.assertEqual(index.lookup("zzz")["source"], "none")
+        index.update(["The Office"])
+        self.assertEqual(len(index), 1)
+
+class phrase_index_tests(unittest.TestCase):
+    def tearDown(self):
+        plugin_handler.phrase_indexes.pop("phrase_test", None)
+    def test_matching(self):
+        phrase_index = plugin_handler.register_phrases("phrase_test", ["tell me a joke", "what is the weather"])
+        self.assertEqual(phrase_index.best_match(parser.nlp(u"Tell me a joke!")), ("tell me a joke", 1.0))
+        self.assertEqual(phrase_index.best_match(parser.nlp(u"please tell me a funny joke"))[0], "tell me a joke")
+        #Only exact phrases reach a similarity of 1
+        self.assertEqual(phrase_index.best_match(parser.nlp(u"please tell me a funny joke"), threshold=1.01), None)
+    def test_update(self):
+        plugin_handler.register_phrases("phrase_test", ["tell me a joke"])
+        phrase_index = plugin_handler.register_phrases("phrase_test", ["what is the weather"])
+        #Registering a corpus again replaces it
+        self.assertIs(plugin_handler.phrase_indexes["phrase_test"], phrase_index)
+        self.assertEqual(phrase_index.best_match(parser.nlp(u"tell me a joke"), threshold=1.0), None)
+        self.assertEqual(phrase_index.best_match(parser.nlp(u"what is the weather")), ("what is the weather", 1.0))
+    def test_empty(self):
+        empty_index = plugin_handler.register_phrases("phrase_test", [])
+        self.assertEqual(empty_index.best_match(parser.nlp(u"tell me a joke")), None)
+        phrase_index = plugin_handler.register_phrases("phrase_test", ["tell me a joke"])
+        self.assertEqual(phrase_index.best_match(parser.nlp(u"")), None)
+
+class FakeClock():
+    def __init__(self, now):
+        self.now = now
+    def time(self):
+        return self.now
+
+class FakeObservation():
+    def __init__(self, location_id, weather):
+        self.location_id = location_id
+        self.weather = weather
+    def get_weather(self):
+        return self.weather
+    def get_location(self):
+        return self
+    def get_ID(self):
+        return self.location_id
+
+class FakeOWM():
+    def __init__(self):
+        self.place_calls = []
+        self.id_calls = []
+        self.place_ids = {"Boston, MA": 1, "Paris, FR": 2}
+    def weather_at_place(self, location):
+        self.place_calls.append(location)
+        return FakeObservation(self.place_ids[location], "place weather {0}".format(len(self.place_calls)))
+    def weather_at_ids(self, location_ids):
+        self.id_calls.append(list(location_ids))
+        return [FakeObservation(location_id, "group weather") for location_id in location_ids]
+
+class weather_tests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        #Imported the way the plugin loader imports it, so it isn't subscribed twice
+        if "core/plugins" not in sys.path:
+            sys.path.append("core/plugins")
+        cls.weather = importlib.import_module("weather")
+    def setUp(self):
+        weather = self.weather
+        self.owm = FakeOWM()
+        self.clock = FakeClock(1000000)
+        self.top_locations = []
+        self.saved = [(weather, "get_client", weather.get_client), (weather, "time", weather.time),
+                      (cache, "time", cache.time), (tools, "load_key", tools.load_key),
+                      (repository, "top_locations", repository.top_locations)]
+        weather.get_client = lambda key: self.owm
+        weather.time = self.clock
+        cache.time = self.clock
+        tools.load_key = lambda key_type, db: "test_key"
+        repository.top_locations = lambda db, limit: self.top_locations
+        weather.weather_cache.clear()
+        weather.location_ids.clear()
+    def tearDown(self):
+        for module, name, value in self.saved:
+            setattr(module, name, value)
+        self.weather.weather_cache.clear()
+        self.weather.location_ids.clear()
+    def test_cache_hit(self):
+        self.assertEqual(self.weather.get_weather("Boston, MA", db), "place weather 1")
+        self.assertEqual(self.weather.get_weather("boston, ma", db), "place weather 1")
+        self.assertEqual(self.owm.place_calls, ["Boston, MA"])
+    def test_expiry(self):
+        self.weather.get_weather("Boston, MA", db)
+        self.clock.now += self.weather.weather_cache.ttl+1
+        self.assertEqual(self.weather.get_weather("Boston, MA", db), "place weather 2")
+        self.assertEqual(len(self.owm.place_calls), 2)
+    def test_refresh_replaces_stale(self):
+        self.weather.get_weather("Boston, MA", db)
+        self.top_locations = [{"city": "Boston", "state": "MA", "country": "US"},
+                              {"city": "Paris", "state": None, "country": "FR"}]
+        #Boston goes stale within the refresh margin, and Paris has never been fetched
+        self.clock.now += self.weather.weather_cache.ttl-self.weather.refresh_margin+1
+        self.weather.refresh(db)
+        #Boston's city id is known, so it's refreshed through the group endpoint
+        self.assertEqual(self.owm.id_calls, [[1]])
+        self.assertEqual(self.owm.place_calls, ["Boston, MA", "Paris, FR"])
+        self.assertEqual(self.weather.get_weather("Boston, MA", db), "group weather")
+        self.assertEqual(self.weather.weather_cache.expires_at("boston ma"),
+                         self.clock.now+self.weather.weather_cache.ttl)
+        #Fresh locations aren't refreshed again
+        self.weather.refresh(db)
+        self.assertEqual(len(self.owm.id_calls)+len(self.owm.place_calls), 3)
+
+class search_fan_out_tests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        if "core/plugins" not in sys.path:
+            sys.path.append("core/plugins")
+        cls.search = importlib.import_module("search")
+    def setUp(self):
+        search = self.search
+        self.saved = [(search, name, getattr(search, name)) for name in
+                      ("search_wolfram", "search_wikipedia", "search_article", "search_deadline")]
+        self.saved.append((tools, "load_key", tools.load_key))
+        tools.load_key = lambda key_type, db: "test_key"
+    def tearDown(self):
+        for module, name, value in self.saved:
+            setattr(module, name, value)
+    def set_backends(self, wolfram, wikipedia, article):
+        self.search.search_wolfram = lambda query, api_key: wolfram()
+        self.search.search_wikipedia = lambda query: wikipedia()
+        self.search.search_article = lambda query: article()
+    @staticmethod
+    def answer_after(seconds, answer):
+        def backend():
+            time.sleep(seconds)
+            return answer
+        return backend
+    def test_priority(self):
+        #Article answers first, but wikipedia ranks higher, so its answer is waited for
+        self.set_backends(self.answer_after(0, False), self.answer_after(0.1, "wikipedia answer"),
+                          self.answer_after(0, "article answer"))
+        self.assertEqual(self.search.fan_out("query", db), ("wikipedia answer", "wikipedia"))
+    def test_backend_error(self):
+        def failing_backend():
+            raise ValueError("backend down")
+        self.set_backends(failing_backend, self.answer_after(0, False), self.answer_after(0, "article answer"))
+        self.assertEqual(self.search.fan_out("query", db), ("article answer", "article"))
+        self.set_backends(failing_backend, failing_backend, self.answer_after(0, False))
+        self.assertEqual(self.search.fan_out("query", db), (False, None))
+    def test_deadline(self):
+        self.search.search_deadline = 0.2
+        self.set_backends(self.answer_after(1, "wolfram answer"), self.answer_after(0, "wikipedia answer"),
+                          self.answer_after(0, "article answer"))
+        start_time = time.time()
+        #Wolfram is still running at the deadline, so the best finished answer is used
+        self.assertEqual(self.search.fan_out("query", db), ("wikipedia answer", "wikipedia"))
+        self.assertLess(time.time()-start_time, 0.9)
+    def test_no_wolfram_keys(self):
+        def no_keys(key_type, db):
+            raise keys.KeysExhausted("No usable wolfram keys")
+        tools.load_key = no_keys
+        self.set_backends(self.answer_after(0, "wolfram answer"), self.answer_after(0, "wikipedia answer"),
+                          self.answer_after(0, False))
+        self.assertEqual(self.search.fan_out("query", db), ("wikipedia answer", "wikipedia"))
+
+class time_parser_tests(unittest.TestCase):
+    def setUp(self):
+        self.tz = pytz.timezone("America/New_York")
+        self.now = self.tz.localize(datetime.datetime(2017, 3, 1, 16, 30))
+    def test_relative(self):
+        self.assertEqual(timeparse.parse("in 5 minutes", self.now, self.tz), 300)
+        self.assertEqual(timeparse.parse("in an hour", self.now, self.tz), 3600)
+        self.assertEqual(timeparse.parse("in 1 hour and 30 minutes", self.now, self.tz), 5400)
+    def test_absolute(self):
+        #3:00 has passed on both clocks today, so it's 3 AM tomorrow
+        self.assertEqual(timeparse.parse("at 3:00", self.now, self.tz), 10.5*3600)
+        self.assertEqual(timeparse.parse("at 5", self.now, self.tz), 1800)
+        self.assertEqual(timeparse.parse("tomorrow at 9", self.now, self.tz), 16.5*3600)
+        self.assertEqual(timeparse.parse("9 p.m.", self.now, self.tz), 4.5*3600)
+    def test_fallback(self):
+        self.assertEqual(timeparse.parse("next friday", self.now, self.tz), None)
+
+class recurrence_tests(unittest.TestCase):
+    def test_next_occurrence(self):
+        event = {"time": 1000, "recurrence": "hourly"}
+        self.assertEqual(core.next_occurrence(event, 500), 1000)
+        self.assertEqual(core.next_occurrence(event, 1000), 4600)
+        #Missed occurrences are skipped
+        self.assertEqual(core.next_occurrence(event, 1000+3600*5+10), 1000+3600*6)
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,13 +2,12 @@
 import logging
 import json
 import core
+import core.updates as updates
+import core.keys as keys
+import core.metrics as metrics
 import uuid
 import time
 import base64
-try:
-    import queue as Queue
-except ImportError:
-    import Queue
 import datetime
 import string
 
@@ -18,8 +17,6 @@ log = logging.getLogger()
 
 log.debug("Valid SQL characters are {0}".format(valid_chars))
 
-session_nums = 0
-
 command_nums = {}
 
 event_types = {
@@ -54,7 +51,7 @@ def gen_session(username, client_type, db):
     :param client:
     :return: session_id
     """
-    session_id = get_session_id(db)
+    session_id = get_session_id()
     # Start monitoring notifications
     # Register a session id
     core.sessions.update({
@@ -62,7 +59,7 @@ def gen_session(username, client_type, db):
             "username": username,
             "commands": [],
             "created": datetime.datetime.now(),
-            "updates": Queue.Queue(),
+            "updates": updates.UpdateQueue(session_id),
             "id": session_id,
             "client": client_type
         }
@@ -121,49 +118,33 @@ def dump_events(events, db):
 
 def load_key(key_type, db, load_url=False):
     """
-    Load a key from the database and implement the cycler
+    Load the least used key of a type from the in memory key rotator.
+    Uses are counted in memory and written to the database in batches
 
     :param key_type:
     :param db:
     :param load_url:
     :return api key:
     """
-    working_keys = db.query('SELECT * FROM `keys` WHERE type="{0}" and uses <= max_uses'.format(key_type))
-    correct_key = sorted(working_keys, key=lambda x: x["num"])[0]
-    key_uses = correct_key["uses"]
+    correct_key = keys.get_rotator(db).use(key_type)
     key_value = correct_key["value"]
-    updated_uses = key_uses+1
-    #Assume that keys reset monthly
-    db['keys'].update(dict(type=key_type, num=correct_key['num'], uses=updated_uses), ['type', 'num'])
     if load_url:
         return (key_value, correct_key["url"])
     return key_value
 
-def initialize_session_tracking(db):
-    """
-    Deprecated and out of use
-
-    :param db:
+def get_session_id(db=None):
     """
-    vars = db["vars"]
-    session_increment = vars.find_one(name="session_incremnet")
-    log.debug("Found session increment {0} from server".format(session_increment))
-    global session_nums
-    session_nums = session_increment
+    Generate a session id in memory. Ids are random uuids checked against the active sessions,
+    and the number of sessions created is kept in the metrics counters instead of the database
 
-def get_session_id(db):
-    """
-    Incrementer for session ids
-    :param db:
+    :param db: Unused, kept so older callers still work
+    :return session id string:
     """
-    global session_nums
-    session_nums+=1
-    session_id = uuid.uuid1()
-    session_str = str(session_id)
+    session_str = str(uuid.uuid4())
+    while session_str in core.sessions:
+        session_str = str(uuid.uuid4())
+    metrics.increment("sessions_created")
     log.debug("Generated session_id {0}".format(session_str))
-    log.debug("Updating session increment in db")
-    data = dict(name="session_id", value=session_nums)
-    db['vars'].update(data, ['name'])
     return session_str
 
 def get_command_id(session_id):
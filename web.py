@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 import core
+import core.auth as auth
+import core.updates as updates
+import core.metrics as metrics
+import core.repository as repository
+import core.write_behind as write_behind
+import core.cache as cache
 from flask import Blueprint, render_template, redirect, request, session, make_response, Response, stream_with_context
-import bcrypt
+from flask_socketio import join_room
 import logging
-import threading
-import time
+import json
 import tools
 import requests
 
@@ -17,6 +22,24 @@ socketio = None
 
 web = Blueprint('web', __name__, template_folder='templates')
 
+users_page_size = 50
+
+def get_report_data():
+    """
+    Collect the statistics for the admin report from the live aggregates kept by core.sessions
+    :return dict of statistics:
+    """
+    report_data = core.sessions.stats()
+    report_data.update({
+        "start_time": start_time,
+        "commands_processed": core.processed_commands,
+        "errors": core.error_num,
+        "success": core.success_num,
+        "sessions_created": metrics.get("sessions_created"),
+        "caches": cache.stats()
+    })
+    return report_data
+
 @web.route("/signup")
 def signup():
     """
@@ -27,27 +50,38 @@ def signup():
     return render_template("signup.html")
 
 
-def update_loop(session_id, sid):
+update_subscribers = {}
+
+def dispatch_updates():
     """
-    :param session_id: W.I.L.L session id
-    :param sid: Flask session id
-    Update thread that will emit socket.io updates to the user while they're connected
+    Single dispatcher that emits socket.io updates for every subscribed session.
+    It blocks until a session's update queue is written to, then empties that queue into the session's room
 
-    :return:
     """
-    while session_id in core.sessions.keys():
-        try:
-            session_data = core.sessions[session_id]
-        except KeyError:
-            #Session ended while loop was sleeping
-            break
-        session_updates = session_data["updates"]
-        while not session_updates.empty():
-            update = session_updates.get()
-            log.debug("Pushing update {0}".format(update))
-            socketio.emit('update', update, room=sid)
-        time.sleep(1)
-    log.info(":{0}:Ending updates for finished session".format(session_id))
+    log.info(":SOCKET:Starting update dispatcher")
+    while True:
+        dispatch_session(updates.ready_sessions.get())
+
+def dispatch_session(session_id):
+    """
+    Emit every queued update of a session to its room. Updates of every type are passed through as they are
+
+    :param session_id:
+    :return the number of updates emitted:
+    """
+    if not update_subscribers.get(session_id):
+        return 0
+    session_data = core.sessions.get(session_id)
+    if session_data is None:
+        log.info(":{0}:Ending updates for finished session".format(session_id))
+        update_subscribers.pop(session_id, None)
+        return 0
+    emitted = 0
+    for update in session_data["updates"].drain():
+        log.debug("Pushing update {0}".format(update))
+        socketio.emit('update', update, room=session_id)
+        emitted += 1
+    return emitted
 
 
 def disconnect_session():
@@ -58,8 +92,12 @@ def disconnect_session():
     """
     log.info(":SOCKET:disconnect")
     session_id = session["session_id"]
+    if session_id in update_subscribers.keys():
+        update_subscribers[session_id].discard(request.sid)
     if session_id in core.sessions.keys():
         log.info(":{0}:Session disconnected".format(session_id))
+        if not update_subscribers.get(session_id):
+            core.sessions[session_id]["updates"].subscribed = False
         #del core.sessions[session_id]
     else:
         log.debug(":{0}:Session id wasn't found in core.sessions".format(session_id))
@@ -74,7 +112,7 @@ def settings_page():
     if "username" in session.keys():
         if "logged-in" in session.keys():
             if session["logged-in"]:
-                session["user"] = db["users"].find_one(username=session["username"])
+                session["user"] = repository.user_by_username(db, session["username"])
                 if session["user"]:
                     return render_template("settings.html")
     return redirect("/")
@@ -93,10 +131,15 @@ def get_updates(data):
             log.debug("{1}:Subscribing client {0} to updates for session_id".format(
                 request.environ["REMOTE_ADDR"], session_id
             ))
-            #Keep running this loop while the session is active
-            log.info(":{0}:Starting update loop".format(session_id))
-            update_thread = threading.Thread(target=update_loop, args=(session_id, request.sid))
-            update_thread.start()
+            #Put the client in the session's room and let the dispatcher know that updates should be pushed
+            log.info(":{0}:Subscribing to updates".format(session_id))
+            join_room(session_id)
+            update_subscribers.setdefault(session_id, set()).add(request.sid)
+            session_updates = core.sessions[session_id]["updates"]
+            session_updates.subscribed = True
+            #Flush anything that was queued before the client subscribed
+            if not session_updates.empty():
+                updates.ready_sessions.put(session_id)
         else:
             log.debug("Session id {0} is invalid".format(session_id))
             socketio.emit("update", {"value": "Error, invalid session id"})
@@ -115,15 +158,15 @@ def login():
         username = str(request.form["username"])
         password = request.form["password"]
         if all(tools.check_string(x) for x in [username, password]):
-            user_table = db["users"].find_one(username=username)
+            user_table = repository.user_by_username(db, username)
             db_hash = user_table["password"]
-            if bcrypt.checkpw(password.encode('utf8'), db_hash.encode('utf8')):
+            if auth.check_password(password, db_hash):
                 log.info(":{0}:Logged in user".format(username))
                 #Generate user token
                 session["logged-in"] = True
                 session["username"] = username
                 user_token = tools.get_user_token(username)
-                db['users'].upsert({"username":username, "user_token":user_token}, ['username'])
+                write_behind.upsert(db, "users", {"username":username, "user_token":user_token}, ['username'])
                 response["type"] = "success"
                 response["text"] = "Authentication successful"
                 response["data"].update({"user_token":user_token})
@@ -133,6 +176,9 @@ def login():
         else:
             response["type"] = "error"
             response["text"] = "Invalid input, allowed characters are {0}".format(tools.valid_chars)
+    except auth.AuthBusy:
+        response["type"] = "error"
+        response["text"] = "The server is busy, please try again in a moment"
     except KeyError:
         response["type"] = "error"
         response["text"] = "Couldn't find username and password in request data"
@@ -164,13 +210,17 @@ def main():
         session["debug_http"] = True
     session["first-command"] = True
     if username:
-        user_table = db["users"].find_one(username=username)
+        user_table = repository.user_by_username(db, username)
+        #The newest token might still be waiting in the write behind buffer
+        pending_user = write_behind.pending_row("users", {"username": username})
+        if pending_user:
+            user_table.update(pending_user)
         if "user_token" in user_table.keys() and "user_token" in session.keys():
             user_token = session["user_token"]
             if user_table["user_token"] == user_token:
                 log.info(":{0}:User authenticated via user_token in cookies".format(username))
                 new_token = tools.get_user_token(username)
-                db["users"].upsert({"username":username, "user_token": new_token}, ['username'])
+                write_behind.upsert(db, "users", {"username":username, "user_token": new_token}, ['username'])
                 session["logged-in"] = True
                 user_first_name = user_table["first_name"]
                 session["welcome-message"] = "Welcome back {0}".format(user_first_name)
@@ -187,7 +237,7 @@ def main():
                 return resp
             else:
                 log.debug("User tokens don't match.\n{0}\n{1}".format(request.cookies.get("user_token"),
-                                                                     db["users"].find_one(username=username)["user_token"]))
+                                                                     user_table["user_token"]))
                 session["logged-in"] = False
         else:
             log.debug("Couldn't find user token in cookies")
@@ -198,7 +248,7 @@ def main():
     #If the cookies aren't found
     return render_template('index.html')
 
-@web.route('/admin/<path>', methods=["GET"])
+@web.route('/admin/<path>', methods=["GET", "POST"])
 def report(path):
     """
     Render template for admin-only reporting page or bounce a non admin user back to /
@@ -207,28 +257,52 @@ def report(path):
     """
     log.info(":WEB:/admin/{0}".format(path))
     if "username" in session.keys() and "logged-in" in session.keys() and session["logged-in"]:
-        user_table = db["users"].find_one(username=session["username"])
+        user_table = repository.user_by_username(db, session["username"])
         if user_table:
             if user_table["admin"]:
-                #Get the session_data
-                session["commands-processed"] = core.processed_commands
-                time_str = start_time
-                session["start-time"] = start_time
-                users_online = 0
-                users_processed = []
-                for session_id in core.sessions:
-                    session_data = core.sessions[session_id]
-                    session_user = session_data["username"]
-                    if session_user not in users_processed:
-                        users_processed.append(str(session_user))
-                        users_online+=1
-                session["users-online"] = users_online
-                session["active-sessions"] = len(core.sessions)
-                session["errors"] = core.error_num
-                session["success"] = core.success_num
-                session["users-list"] = users_processed
                 if path == "report":
-                    return render_template('report.html')
+                    try:
+                        page = max(int(request.args.get("page", 0)), 0)
+                    except ValueError:
+                        page = 0
+                    report_data = get_report_data()
+                    users_list = core.sessions.online_users(page, users_page_size)
+                    last_page = max(report_data["users_online"]-1, 0) // users_page_size
+                    return render_template('report.html', report=report_data, users_list=users_list,
+                                           page=page, last_page=last_page)
+                elif path == "report.json":
+                    return Response(json.dumps(get_report_data()), content_type="application/json")
+                elif path == "history":
+                    #Time series for the report charts, or the list of series if none was requested
+                    series_name = request.args.get("series")
+                    resolution = request.args.get("resolution", "minute")
+                    try:
+                        points = int(request.args.get("points", 60))
+                    except ValueError:
+                        points = 60
+                    if series_name and resolution in [r[0] for r in metrics.resolutions]:
+                        history_data = {"series": series_name, "resolution": resolution,
+                                        "points": metrics.history(series_name, resolution, points)}
+                    else:
+                        history_data = {"series": sorted(metrics.series.keys())}
+                    return Response(json.dumps(history_data), content_type="application/json")
+                elif path == "purge_cache" and request.method == "POST":
+                    #Purge a named cache, or just the entries whose keys start with prefix
+                    response = {"type": "success", "text": None, "data": {}}
+                    cache_name = request.form.get("cache")
+                    prefix = request.form.get("prefix")
+                    if cache_name in cache.caches:
+                        named_cache = cache.caches[cache_name]
+                        purged = named_cache.purge(prefix) if prefix else named_cache.clear()
+                        log.info(":{0}:Purged {1} entries from cache {2}".format(
+                            session["username"], purged, cache_name))
+                        response["text"] = "Purged {0} entries".format(purged)
+                        response["data"].update({"purged": purged})
+                    else:
+                        response["type"] = "error"
+                        response["text"] = "Unknown cache {0}, caches are {1}".format(
+                            cache_name, sorted(cache.caches.keys()))
+                    return tools.return_json(response)
                 elif path == "logging":
                     if "log_proxy" in configuration_data.keys():
                         req = requests.get(configuration_data["log_proxy"], stream=True)
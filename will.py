@@ -1,7 +1,13 @@
+# Patch the standard library first so that blocking waits on update queues yield to other greenlets
+try:
+    from gevent import monkey
+    monkey.patch_all()
+except ImportError:
+    pass
+
 # External imports
 from flask import Flask
 from flask_socketio import SocketIO
-import dataset
 
 # Builtin imports
 import logging
@@ -19,6 +25,12 @@ import signal
 
 # Internal imports
 import core
+import core.auth as auth
+import core.rate_limit as rate_limit
+import core.updates as updates
+import core.repository as repository
+import core.schema as schema
+import core.write_behind as write_behind
 import API
 import web
 
@@ -41,6 +53,10 @@ class will:
                     db["events"].upsert(event, ['uid'])
                 except:
                     print(":SYS:Error encountered while dumping events")
+        try:
+            write_behind.flush()
+        except:
+            print(":SYS:Error encountered while flushing queued writes")
 
     def start(self):
         """
@@ -51,13 +67,22 @@ class will:
         log.info(":SYS:Starting W.I.L.L")
         db_url = self.configuration_data["db_url"]
         log.info(":SYS:Connecting to database")
-        db = dataset.connect(db_url, engine_kwargs={"pool_recycle": 1})
+        db = repository.connect(db_url, self.configuration_data)
+        log.info(":SYS:Updating database schema")
+        schema.migrate(db)
         core.db = db
         API.db = db
         web.db = db
+        log.info(":SYS:Starting write behind buffer")
+        write_behind.initialize(db, self.configuration_data)
         start_time = self.now.strftime("%I:%M %p %A %m/%d/%Y")
         web.start_time = start_time
+        log.info(":SYS:Starting password hashing pool")
+        auth.initialize(self.configuration_data, db)
+        rate_limit.initialize(self.configuration_data)
+        updates.initialize(self.configuration_data)
         log.info(":SYS:Starting W.I.L.L core")
+        core.configuration_data = self.configuration_data
         core.initialize(db)
         log.info(":SYS:Starting sessions parsing thread")
         core.sessions_monitor(db)
@@ -112,6 +137,8 @@ class will:
 
         self.start()
 
+        self.socketio.start_background_task(web.dispatch_updates)
+
         self.socketio.run(
             app, host=self.configuration_data["host"], port=self.configuration_data["port"], debug=self.configuration_data["debug"]
             , use_reloader=False)